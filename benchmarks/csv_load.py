@@ -0,0 +1,136 @@
+"""Benchmark CsvDict.load_file() against the previous DictReader based
+load (read the headers, seek back, and re-read the file through a
+csv.DictReader with a dict per row).
+
+Usage:
+
+python benchmarks/csv_load.py [--rows 1000000] [--repeat 2] [FILE]
+
+Without a file, a CSV file with five columns and the given number of
+rows is generated in a temporary directory. The best time of the
+repeats is reported for each case together with the rows read per
+second and the speedup."""
+import argparse
+import csv
+from collections import namedtuple
+from pathlib import Path
+import sys
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from wistools.csv import CsvDict  # noqa: E402
+
+COUNTRIES = ('DK', 'AU', 'US', 'GB', 'DE', 'FR', 'JP', 'NZ', 'SE', 'NO')
+
+
+def generate_file(path: Path, rows: int):
+    """Write a CSV file with an id, name, country, amount, and date column
+    and a totals row without an id at the end."""
+    with path.open('w', newline='', encoding='utf-8') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(['id', 'name', 'country', 'amount', 'date'])
+        for i in range(rows):
+            writer.writerow([i, f'Customer {i}', COUNTRIES[i % 10],
+                             f'{i * 0.37:.2f}',
+                             f'2023-{i % 12 + 1:02d}-{i % 28 + 1:02d}'])
+        writer.writerow(['', 'Total', '', '', ''])
+
+
+def dict_reader_load(path: Path, require_column: str = '',
+                     filters: (dict or None) = None) -> dict:
+    """Load the file the way CsvDict.load_file() did before the single
+    pass reader."""
+    with path.open(mode='r', encoding='utf-8-sig') as csvfile:
+        headers = next(csv.reader(csvfile))
+        row_tuple = namedtuple('CsvRow', headers)
+        csvfile.seek(0)
+        rows = {}
+        i = 0
+        for row in csv.DictReader(csvfile, headers):
+            i += 1
+            if i <= 1:
+                continue
+            if require_column != '' and row[require_column] == '':
+                continue
+            row_value = row_tuple(*row.values())
+            include = True
+            if filters is not None:
+                for key, filter_value in filters.items():
+                    if getattr(row_value, key) != filter_value:
+                        include = False
+            if include:
+                rows[row_value.id] = row_value
+    return rows
+
+
+def csv_dict_load(path: Path, require_column: str = '',
+                  filters: (dict or None) = None) -> dict:
+    """Load the file with CsvDict.load_file()."""
+    csv_dict = CsvDict()
+    csv_dict.load_file(path, key='id', require_column=require_column,
+                       filters=filters)
+    return csv_dict.rows
+
+
+def best_time(function, path: Path, repeat: int, **kwargs) -> tuple:
+    """Return the best time of the repeats and the number of rows
+    loaded."""
+    best = None
+    rows = 0
+    for _ in range(repeat):
+        start = perf_counter()
+        rows = len(function(path, **kwargs))
+        elapsed = perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, rows
+
+
+def count_rows(path: Path) -> int:
+    """Return the number of data rows (after the header row)."""
+    with path.open(mode='r', encoding='utf-8-sig', newline='') as csvfile:
+        return sum(1 for _ in csv.reader(csvfile)) - 1
+
+
+def run(path: Path, repeat: int):
+    rows = count_rows(path)
+    cases = (
+        ('plain', {}),
+        ("filters={'country': 'DK'}", {'filters': {'country': 'DK'}}),
+        ("require_column='id'", {'require_column': 'id'}),
+    )
+    print(f'{"Case":28s} {"DictReader":>12s} {"load_file":>12s} ' +
+          f'{"Rows/s":>12s} {"Speedup":>8s}')
+    for name, kwargs in cases:
+        old, old_rows = best_time(dict_reader_load, path, repeat, **kwargs)
+        new, new_rows = best_time(csv_dict_load, path, repeat, **kwargs)
+        if old_rows != new_rows:
+            raise ValueError(f'{name}: the loads returned {old_rows} and ' +
+                             f'{new_rows} rows')
+        print(f'{name:28s} {old:11.2f}s {new:11.2f}s ' +
+              f'{rows / new:12,.0f} {old / new:7.1f}x')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('file', nargs='?', type=Path,
+                        help='CSV file with an id and a country column')
+    parser.add_argument('--rows', type=int, default=1000000,
+                        help='rows in the generated file')
+    parser.add_argument('--repeat', type=int, default=2,
+                        help='number of loads for each case')
+    args = parser.parse_args()
+    if args.file is not None:
+        run(args.file, args.repeat)
+        return
+
+    with TemporaryDirectory() as directory:
+        path = Path(directory) / 'benchmark.csv'
+        generate_file(path, args.rows)
+        run(path, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
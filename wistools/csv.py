@@ -2,14 +2,74 @@
 Class for working with CSV files.
 """
 
-from collections import namedtuple
+from array import array
+from bisect import bisect_left, bisect_right
+from codecs import getincrementaldecoder
+from collections import deque, namedtuple
+from collections.abc import Sized
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
 import csv
+import gc
+from functools import partial
+from hashlib import blake2b
+from io import BufferedReader, BufferedWriter, StringIO, TextIOWrapper
+from itertools import chain, count, islice
+import marshal
+from math import fsum, nan
+from mimetypes import guess_type
+from mmap import ACCESS_READ, mmap
+from os import SEEK_END, cpu_count, fstat
+from operator import attrgetter, itemgetter
 from pathlib import Path
 import re
+import struct
+import sys
+from zipfile import ZipFile
 
+from .io import atomic_write, get_files, open_file
 
-def _validate_headers(header_row: dict, expected: list):
-    actual = [h for h in list(header_row.values())]
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Files smaller than this are always loaded in a single process
+_PARALLEL_MIN_SIZE = 1 << 20
+
+# The size of the read buffer for compressed files
+_READ_BUFFER_SIZE = 1 << 20
+
+# The size of the blocks read backwards from the end of a file to find
+# the start of the last record
+_TAIL_BLOCK_SIZE = 1 << 16
+
+# The size of the write buffer when writing CSV files
+_WRITE_BUFFER_SIZE = 1 << 20
+
+# The cache files for parsed CSV files. The header has the magic, the size
+# and modification time of the CSV file, and the digest of the arguments.
+CACHE_SUFFIX = '.wiscache'
+_CACHE_MAGIC = b'WISCSV03'
+_CACHE_HEADER = struct.Struct('<8sQq32s')
+
+# The number of bytes at the start of a file used to detect that the file
+# has been replaced when refreshing
+_PREFIX_SIZE = 4096
+
+# How a file was loaded and where the next refresh continues from. The
+# pending key is a 1-tuple with the key of the row loaded from a last
+# record that was not complete, which the next refresh replaces.
+_LoadState = namedtuple('_LoadState', ['arguments', 'quote', 'offset',
+                                       'device', 'inode', 'prefix',
+                                       'pending'])
+
+# The array type codes used for the typed columns
+_COLUMN_TYPECODES = {int: 'q', float: 'd'}
+
+
+def _validate_headers(header_row: list, expected: list):
+    actual = list(header_row)
     if len(expected) != len(actual):
         raise ValueError(f'The number of headers ({len(actual)} differs ' +
                          f'from the expected ({len(expected)}).')
@@ -47,6 +107,360 @@ def _headers_to_properties(headers: list) -> list:
     return [_header_to_property(h) for h in headers]
 
 
+def _column_index(names: list, name: str, kind: str) -> int:
+    """Return the index of a column name (a header or property)."""
+    try:
+        return list(names).index(name)
+    except ValueError:
+        raise ValueError(f'No {kind} exists with the name "{name}" - ' +
+                         f'valid names: {names}') from None
+
+
+class Range(object):
+    """A filter matching values between low and high (both inclusive).
+    The raw string value is converted with convert before comparing, so
+    for example convert=date.fromisoformat with date bounds gives a
+    date range. A bound of None means the range is open in that end.
+    Values that cannot be converted do not match."""
+    _low = None
+    _high = None
+    _convert = float
+
+    def __init__(self, low=None, high=None, convert=float):
+        self._low = low
+        self._high = high
+        self._convert = convert
+
+    @property
+    def low(self):
+        return self._low
+
+    @property
+    def high(self):
+        return self._high
+
+    @property
+    def convert(self):
+        return self._convert
+
+    def __call__(self, value) -> bool:
+        try:
+            value = self._convert(value)
+        except (TypeError, ValueError):
+            return False
+        if self._low is not None and value < self._low:
+            return False
+        if self._high is not None and value > self._high:
+            return False
+        return True
+
+    def __repr__(self):
+        return f'Range({self._low!r}, {self._high!r}, ' + \
+               f'convert={self._convert!r})'
+
+
+def _filter_test(expected):
+    """Return a function testing a single raw value against a filter
+    value. Sets match on membership, compiled regular expressions match
+    if they are found anywhere in the value, callables (including
+    Range) match if they return a true value, and anything else must be
+    equal to the value."""
+    if isinstance(expected, (set, frozenset)):
+        return expected.__contains__
+    if isinstance(expected, re.Pattern):
+        search = expected.search
+        return lambda value: value is not None and \
+            search(value) is not None
+    if callable(expected):
+        return expected
+    return lambda value: value == expected
+
+
+def _compile_filters(filters: (dict or None), properties: list,
+                     filter_mode: str = 'and'):
+    """Compile the filters (property name to filter value) into one
+    predicate taking the row as a list of values. The filters are
+    combined with and or or depending on filter_mode. Returns None if
+    there are no filters."""
+    if filter_mode not in ('and', 'or'):
+        raise ValueError(f'Unknown filter mode "{filter_mode}" - ' +
+                         'supported modes: and, or')
+    if filters is None or len(filters) == 0:
+        return None
+    indexes = [_column_index(properties, key, 'property') for key in filters]
+    values = list(filters.values())
+    if len(indexes) == 1:
+        index = indexes[0]
+        test = _filter_test(values[0])
+        return lambda row: test(row[index])
+
+    if filter_mode == 'and' and all(isinstance(v, str) for v in values):
+        # Plain equality on all columns - compare all values in one go
+        getter = itemgetter(*indexes)
+        expected = tuple(values)
+        return lambda row: getter(row) == expected
+
+    tests = [(index, _filter_test(value))
+             for index, value in zip(indexes, values)]
+    if filter_mode == 'and':
+        return lambda row: all(test(row[i]) for i, test in tests)
+    return lambda row: any(test(row[i]) for i, test in tests)
+
+
+def _indexed_pairs(pairs, indexes: list):
+    """Add the rows of the (key, row) pairs to the indexes as they pass
+    through."""
+    for pair in pairs:
+        for index in indexes:
+            index.add(pair[1])
+        yield pair
+
+
+def _new_keys(pairs, rows: dict, duplicates: str, source: str):
+    """Filter the (key, row) pairs for keys already in rows. With
+    duplicates='first' the pairs are skipped, with 'error' a ValueError
+    is raised. The check also covers the pairs passed before, as they
+    are added to rows while iterating."""
+    for pair in pairs:
+        if pair[0] in rows:
+            if duplicates == 'first':
+                continue
+            raise ValueError(f'The key {pair[0]!r} in {source} has ' +
+                             'already been loaded.')
+        yield pair
+
+
+class ColumnDictionary(object):
+    """The distinct values of a dictionary encoded column. Each distinct
+    value is stored once and all the rows share that object, and the
+    position of the value in values is its code. With a limit, the
+    dictionary is marked as overflowed and emptied as soon as there are
+    more distinct values than the limit."""
+    _values: list = []
+    _codes: dict = {}
+    _shared: dict = {}
+    _limit: int = 0
+    _overflowed: bool = False
+
+    def __init__(self, limit: int = 0):
+        self._values = []
+        self._codes = {}
+        self._shared = {}
+        self._limit = limit
+        self._overflowed = False
+
+    @property
+    def values(self) -> list:
+        return self._values
+
+    @property
+    def codes(self) -> dict:
+        """The code of each value."""
+        return self._codes
+
+    @property
+    def limit(self) -> int:
+        return self._limit
+
+    @property
+    def overflowed(self) -> bool:
+        return self._overflowed
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    def __contains__(self, value) -> bool:
+        return value in self._codes
+
+    def add(self, values) -> bool:
+        """Add the new distinct values from an iterable of values.
+        Returns False if the dictionary has overflowed."""
+        if self._overflowed:
+            return False
+        for value in set(values).difference(self._codes):
+            if len(self._values) == self._limit > 0:
+                # The column is no longer encoded, so release the values
+                self._overflowed = True
+                self._values = []
+                self._codes = {}
+                self._shared = {}
+                return False
+            self._codes[value] = len(self._values)
+            self._values.append(value)
+            self._shared[value] = value
+        return True
+
+    def encode(self, values) -> list:
+        """Return the values replaced by the shared objects, adding new
+        distinct values to the dictionary. The values are returned as
+        they are if the dictionary has overflowed."""
+        if not isinstance(values, list):
+            values = list(values)
+        if not self.add(values):
+            return values
+        return list(map(self._shared.__getitem__, values))
+
+    def shared(self, value):
+        """Return the shared object for a value or None if the value is
+        not in the dictionary."""
+        return self._shared.get(value)
+
+
+def _encode_rows(rows, encoders: list, num_columns: int,
+                 batch_size: int = 4096):
+    """Return an iterator over the rows (lists of values) with the values
+    of the encoded columns replaced with the shared objects. encoders is
+    a list of (column index, ColumnDictionary) tuples. The rows are
+    handled in batches that are transposed to columns and back, so there
+    is no Python code run per row, and a column is no longer encoded
+    once its dictionary overflows."""
+    rows = iter(rows)
+    encoders = list(encoders)
+
+    def encode_batch(batch: list):
+        if max(map(len, batch)) != num_columns:
+            # Leave it to the row tuple to complain about the long row
+            return batch
+        columns = list(zip(*batch))
+        for index, dictionary in list(encoders):
+            encoded = dictionary.encode(columns[index])
+            if dictionary.overflowed:
+                encoders.remove((index, dictionary))
+            else:
+                columns[index] = encoded
+        return zip(*columns)
+
+    batches = iter(lambda: list(islice(rows, batch_size)), [])
+    return chain.from_iterable(map(encode_batch, batches))
+
+
+class CsvIndex(object):
+    """A secondary index over the rows of a CsvDict. The index is on one
+    or more properties; for several properties the index values are
+    tuples. A unique index maps each value to a single row, otherwise
+    each value maps to a list of rows in the order they were added.
+
+    If convert is given, it is applied to each raw value before it is
+    used in the index, for example float to get numeric range scans.
+    Rows where a value is missing (a short row padded with None) or
+    cannot be converted are not indexed."""
+    _name: str = ''
+    _columns: tuple = ()
+    _unique: bool = False
+    _convert = None
+    _getter = None
+    _entries: dict = {}
+    _sorted_values: (list or None) = None
+    _built: bool = False
+
+    def __init__(self, name: str, columns: (str or list or tuple),
+                 unique: bool = False, convert=None):
+        if isinstance(columns, str):
+            columns = (columns,)
+        if len(columns) == 0:
+            raise ValueError(f'The index "{name}" has no columns.')
+        self._name = name
+        self._columns = tuple(columns)
+        self._unique = unique
+        self._convert = convert
+        self._getter = None
+        self._entries = {}
+        self._sorted_values = None
+        self._built = False
+
+    @property
+    def name(self) -> str:
+        return self._name
+
+    @property
+    def columns(self) -> tuple:
+        return self._columns
+
+    @property
+    def unique(self) -> bool:
+        return self._unique
+
+    @property
+    def built(self) -> bool:
+        return self._built
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def bind(self, properties: list):
+        """Resolve the columns to positions in the rows."""
+        positions = [_column_index(properties, column, 'property')
+                     for column in self._columns]
+        self._getter = itemgetter(*positions)
+
+    def _value(self, row: tuple):
+        value = self._getter(row)
+        if value is None or (len(self._columns) > 1 and None in value):
+            raise ValueError('The row has a missing value.')
+        if self._convert is not None:
+            if len(self._columns) == 1:
+                value = self._convert(value)
+            else:
+                value = tuple(self._convert(v) for v in value)
+        return value
+
+    def add(self, row: tuple):
+        """Add a row to the index."""
+        try:
+            value = self._value(row)
+        except (TypeError, ValueError):
+            return
+        if self._unique:
+            if value in self._entries:
+                raise ValueError(f'Duplicate value {value!r} in the ' +
+                                 f'unique index "{self._name}".')
+            self._entries[value] = row
+        else:
+            rows = self._entries.get(value)
+            if rows is None:
+                self._entries[value] = [row]
+            else:
+                rows.append(row)
+        self._sorted_values = None
+
+    def build(self, rows, properties: list):
+        """Build the index from scratch from an iterable of rows."""
+        self.clear()
+        if len(properties) > 0:
+            self.bind(properties)
+        for row in rows:
+            self.add(row)
+        self._built = True
+
+    def clear(self):
+        self._entries = {}
+        self._sorted_values = None
+        self._built = False
+
+    def lookup(self, value) -> (tuple or list or None):
+        """Return the row (unique index) or a new list of the rows with
+        the value. If there are no rows, None is returned for a unique
+        index and an empty list otherwise."""
+        if self._unique:
+            return self._entries.get(value)
+        return list(self._entries.get(value, ()))
+
+    def scan(self, low=None, high=None):
+        """Yield the rows with index values between low and high (both
+        inclusive) in the order of the values. A bound of None means the
+        scan is open in that end."""
+        if self._sorted_values is None:
+            self._sorted_values = sorted(self._entries)
+        values = self._sorted_values
+        start = 0 if low is None else bisect_left(values, low)
+        stop = len(values) if high is None else bisect_right(values, high)
+        for value in values[start:stop]:
+            if self._unique:
+                yield self._entries[value]
+            else:
+                yield from self._entries[value]
+
+
 class CsvDict(object):
     _row_name: str = 'CsvRow'
     _row_tuple: namedtuple = None
@@ -54,6 +468,9 @@ class CsvDict(object):
     _properties: list = []  # The headers converted to valid property names
     _key: str = ''
     _rows: dict = {}
+    _indexes: dict = {}
+    _load_state: (_LoadState or None) = None
+    _dictionaries: dict = {}
 
     def __init__(self, row_name: str = 'CsvRow'):
         self._row_name = row_name
@@ -62,6 +479,9 @@ class CsvDict(object):
         self._properties = []
         self._key = ''
         self._rows = {}
+        self._indexes = {}
+        self._load_state = None
+        self._dictionaries = {}
 
     @property
     def rows(self) -> dict:
@@ -94,14 +514,71 @@ class CsvDict(object):
                              f'properties: {self.properties}')
         self._key = key
 
+    @property
+    def indexes(self) -> dict:
+        return self._indexes
+
+    def add_index(self, name: str, columns: (str or list or tuple),
+                  unique: bool = False, convert=None) -> CsvIndex:
+        """Declare a secondary index on one or more properties. If no
+        rows have been loaded yet, the index is filled while the rows are
+        loaded, so it also includes rows whose key is later replaced in
+        rows by a row with the same key. Otherwise the index is built
+        from rows the first time it is used. See CsvIndex for unique and
+        convert."""
+        if name in self._indexes:
+            raise ValueError(f'An index named "{name}" already exists.')
+        index = CsvIndex(name, columns, unique, convert)
+        if len(self._rows) == 0:
+            index.build((), self.properties)
+        self._indexes[name] = index
+        return index
+
+    def drop_index(self, name: str):
+        del self._indexes[name]
+
+    def _get_index(self, name: str) -> CsvIndex:
+        try:
+            index = self._indexes[name]
+        except KeyError:
+            raise ValueError(f'No index exists with the name "{name}" - ' +
+                             f'indexes: {list(self._indexes)}') from None
+        if not index.built:
+            index.build(self._rows.values(), self.properties)
+        return index
+
+    def lookup(self, index: str, value) -> (tuple or list or None):
+        """Look up a value in a secondary index. For a composite index,
+        the value is a tuple with a value for each column. Returns the
+        row for a unique index (None if there is no match) and a list of
+        rows otherwise."""
+        return self._get_index(index).lookup(value)
+
+    def scan(self, index: str, low=None, high=None):
+        """Yield the rows with values in the index between low and high
+        (both inclusive) in the order of the index values."""
+        return self._get_index(index).scan(low, high)
+
     def load_file(self, path: (str or Path), key: str = '',
                   headers: (list or tuple) = (),
                   properties: (list or tuple) = (),
                   header_rows: int = 1, validate_headers: bool = False,
                   encoding: str = 'utf-8-sig', delimiter: str = ',',
                   quotechar: str = '"', require_column: str = '',
-                  filters: dict = None):
-        """Load the content of a CSV file. The path is mandatory.
+                  filters: dict = None, filter_mode: str = 'and',
+                  workers: (int or None) = None, member: str = None,
+                  encode_columns: (list or tuple) = (),
+                  encode_threshold: int = 0,
+                  cache: (bool or Path or str) = False):
+        """Load the content of a CSV file. The path is mandatory. The
+        file is opened with wistools.io.open_file(), so gzip, bzip2, and
+        zip files are decompressed on the fly. For a zip file, member is
+        the name of the CSV file in the archive; it can be left out if
+        the archive has a single file or a single .csv file.
+
+        The whole file is loaded. For an uncompressed file, a last
+        record without a newline at the end may still be being written,
+        so refresh() reads it again and replaces its row.
 
         The key argument specifies the column header (as a string) that
         should be used as the key in the row dictionary. If no key is
@@ -125,68 +602,1324 @@ class CsvDict(object):
         a column. If that column does not contain a value (the value is
         an empty string), then the row is skipped. This is for example
         useful if there is a row with totals.
+
+        The filters argument is a dictionary with property names as keys.
+        Only rows matching the filters are loaded. A filter value can be
+        a string (the value must be equal to it), a set of strings (the
+        value must be one of them), a compiled regular expression (it
+        must be found in the value), a Range, or a callable taking the
+        raw string value and returning whether the row matches. The
+        filters are combined with "and" or "or" as set by filter_mode.
+        They are applied to the raw values before the row is created.
+
+        With workers set to more than one, a large file is split into
+        byte ranges at record boundaries and the ranges are parsed in a
+        pool of that many processes. The rows are added in the same
+        order as when loading in a single process, so the result is the
+        same. The filters must be picklable to be sent to the workers
+        (for example module level functions rather than lambdas). Files
+        smaller than 1 MiB, and encodings where the newline and quote
+        characters are not single bytes, are loaded in a single process.
+
+        The properties in encode_columns are dictionary encoded: each
+        distinct value is stored once and shared by all the rows with
+        that value, and the value is assigned a small integer code (see
+        codes(), group_by(), and where()). With encode_threshold, the
+        other columns are encoded as well as long as they have at most
+        that number of distinct values.
+
+        With cache set to True, the parsed rows are stored in a cache
+        file next to the CSV file (the name of the CSV file with a hash
+        of the arguments and the .wiscache suffix added), and if cache is
+        a directory, the cache file is stored there. The
+        next load with the same arguments reads the rows from the cache
+        as long as the size and modification time of the CSV file are
+        unchanged. Sets of filter values give the same cache file
+        whatever their order. Filters without a stable form between runs
+        (lambdas, local functions, and objects with the default repr())
+        turn the cache off, so such loads always parse the file. Loads
+        that write the cache are done in a single process.
         """
+        arguments = dict(path=path, key=key, headers=headers,
+                         properties=properties, header_rows=header_rows,
+                         validate_headers=validate_headers,
+                         encoding=encoding, delimiter=delimiter,
+                         quotechar=quotechar, require_column=require_column,
+                         filters=filters, filter_mode=filter_mode,
+                         workers=workers, member=member,
+                         encode_columns=encode_columns,
+                         encode_threshold=encode_threshold, cache=cache)
+        if cache is not False and cache is not None:
+            digest = _arguments_digest(Path(path), self._row_name, arguments)
+            if digest is not None:
+                self._load_with_cache(Path(path), arguments, digest)
+                return
+
+        quote = _quote_byte(encoding, quotechar)
+        parallel = workers is not None and workers > 1 and \
+            quote is not None and \
+            Path(path).stat().st_size >= _PARALLEL_MIN_SIZE
+        # The last record read, so refresh() knows where it started
+        last = [None]
+        with open_file(path, 'rb') as binfile:
+            plain = isinstance(binfile, BufferedReader)
+            if not parallel or not plain:
+                # Compressed files are always loaded in a single process
+                with _open_text(binfile, encoding, member) as csvfile:
+                    reader = csv.reader(csvfile, delimiter=delimiter,
+                                        quotechar=quotechar)
+                    self._read_headers(reader, headers, properties,
+                                       header_rows, validate_headers)
+                    self._set_key(key)
+                    self._set_encoding(encode_columns, encode_threshold)
+                    self._store_rows(self._iter_rows(
+                        reader, require_column, filters, filter_mode, last))
+                    self._remember_load(binfile if plain else None,
+                                        arguments, quote, last[0])
+                return
+
+            reader = csv.reader(_decoded_lines(binfile, encoding),
+                                delimiter=delimiter, quotechar=quotechar)
+            self._read_headers(reader, headers, properties, header_rows,
+                               validate_headers)
+            start = binfile.tell()
+            end = binfile.seek(0, SEEK_END)
+            self._set_key(key)
+            self._set_encoding(encode_columns, encode_threshold)
+            for values, last_row in self._load_ranges(
+                    Path(path), start, end, quote, encoding, delimiter,
+                    quotechar, require_column, filters, filter_mode,
+                    workers):
+                self._store_values(values)
+                if last_row is not None:
+                    last[0] = last_row
+            self._remember_load(binfile, arguments, quote, last[0])
+
+    def _load_with_cache(self, file: Path, arguments: dict, digest: bytes):
+        """Load the rows from the cache file if it is up to date, otherwise
+        parse the file and write the cache."""
+        stat = file.stat()
+        cache_file = _cache_path(file, arguments['cache'], digest)
+        payload = _read_cache(cache_file, stat, digest)
+        if payload is None:
+            loader = CsvDict(self._row_name)
+            last = [None]
+            with open_file(file, 'rb') as binfile, \
+                    _open_text(binfile, arguments['encoding'],
+                               arguments['member']) as csvfile:
+                reader = csv.reader(csvfile, delimiter=arguments['delimiter'],
+                                    quotechar=arguments['quotechar'])
+                loader._read_headers(
+                    reader, arguments['headers'], arguments['properties'],
+                    arguments['header_rows'], arguments['validate_headers'])
+                values = list(chain.from_iterable(loader._iter_rows(
+                    reader, arguments['require_column'], arguments['filters'],
+                    arguments['filter_mode'], last)))
+            payload = (loader.headers, loader.properties, values, last[0])
+            _write_cache(cache_file, file, stat, digest, payload)
+
+        headers, properties, values, last_row = payload
+        self.headers = list(headers)
+        self.properties = list(properties)
+        self._row_tuple = namedtuple(self._row_name, self.properties)
+        self._set_key(arguments['key'])
+        self._set_encoding(arguments['encode_columns'],
+                           arguments['encode_threshold'])
+        self._store_values(values)
+
+        quote = _quote_byte(arguments['encoding'], arguments['quotechar'])
+        with open_file(file, 'rb') as binfile:
+            plain = isinstance(binfile, BufferedReader)
+            self._remember_load(binfile if plain else None, arguments, quote,
+                                last_row)
+
+    def _remember_load(self, binfile, arguments: dict, quote: (bytes or None),
+                       last_row: (list or None)):
+        """Remember how a file was loaded and where refresh() continues
+        from. That is the end of a plain file, or the start of its last
+        record if the record may still be being written (no newline at
+        the end or an open quoted field). In that case the row loaded
+        from the record is remembered as pending, and refresh() replaces
+        it. The binfile is None for a compressed file, which refresh()
+        reloads, as well as a file where the record boundaries cannot be
+        found. The last_row is the last record read as a list of strings
+        (None if there were no rows after the headers)."""
+        offset = None
+        if binfile is not None and quote is not None:
+            offset, complete = _resume_offset(
+                binfile, last_row, arguments['encoding'],
+                arguments['delimiter'], arguments['quotechar'])
+        if offset is None:
+            self._load_state = _LoadState(arguments, None, None, None, None,
+                                          b'', None)
+            return
+        pending = None
+        if not complete and last_row is not None and \
+                len(last_row) == len(self.properties):
+            key = last_row[self.properties.index(self.key)]
+            row_value = self._rows.get(key)
+            if row_value is not None and tuple(row_value) == tuple(last_row):
+                pending = (key,)
+        status = fstat(binfile.fileno())
+        binfile.seek(0)
+        prefix = binfile.read(min(offset, _PREFIX_SIZE))
+        self._load_state = _LoadState(arguments, quote, offset,
+                                      status.st_dev, status.st_ino, prefix,
+                                      pending)
+
+    def refresh(self) -> int:
+        """Load the records appended to the file since the last call to
+        load_file() or refresh(). Only complete records (ending with a
+        newline) are read, so a record that is still being written is
+        picked up by the next refresh. If the last record loaded was not
+        complete, it is read again and its row replaced. Returns the
+        number of rows read.
+
+        The file is reloaded from the start if it has been truncated or
+        replaced (a different inode or different content at the start of
+        the file), if it is compressed, or if the encoding does not allow
+        finding the record boundaries. A reload replaces all the rows.
+        """
+        state = self._load_state
+        if state is None:
+            raise ValueError('No file has been loaded.')
+        arguments = state.arguments
+        if state.offset is None or state.quote is None:
+            return self._reload()
+        try:
+            binfile = Path(arguments['path']).open(mode='rb')
+        except FileNotFoundError:
+            # The file is being rotated
+            return 0
+        with binfile:
+            status = fstat(binfile.fileno())
+            if status.st_dev != state.device or \
+                    status.st_ino != state.inode or \
+                    status.st_size < state.offset or \
+                    binfile.read(len(state.prefix)) != state.prefix:
+                return self._reload()
+            if status.st_size == state.offset:
+                return 0
+            binfile.seek(state.offset)
+            data = binfile.read()
+
+        end = _last_record_end(data, state.quote)
+        if end == 0:
+            return 0
+        reader = csv.reader(
+            StringIO(data[:end].decode(arguments['encoding']), newline=''),
+            delimiter=arguments['delimiter'],
+            quotechar=arguments['quotechar'])
+        rows = list(self._iter_rows(reader, arguments['require_column'],
+                                    arguments['filters'],
+                                    arguments['filter_mode']))
+        if state.pending is not None:
+            # Replace the row loaded from the incomplete last record
+            self._rows.pop(state.pending[0], None)
+            for index in self._indexes.values():
+                # Filled again on the next use
+                index.clear()
+        self._store_rows(rows)
+        self._load_state = state._replace(offset=state.offset + end,
+                                          pending=None)
+        return len(rows)
+
+    def _reload(self) -> int:
+        """Reload the last loaded file from scratch."""
+        self._rows = {}
+        self._headers = []
+        self._properties = []
+        for index in self._indexes.values():
+            # Fill the indexes again while loading
+            index.build((), ())
+        self.load_file(**self._load_state.arguments)
+        return len(self._rows)
+
+    def _set_key(self, key: str):
+        if key != '':
+            self.key = key
+        elif self.key == '':
+            # Use the first property as the key
+            self.key = self.properties[0]
+
+    def _store_values(self, values: list, duplicates: str = 'last',
+                      source: str = ''):
+        """Store the rows given as one flat list with the values of all
+        the rows (as returned by the workers and read from the cache).
+        The encoded columns are encoded a column at a time before the
+        values are regrouped into row tuples. See _store_rows() for
+        duplicates and source."""
+        num_columns = len(self.properties)
+        for index, dictionary in self._encoders():
+            values[index::num_columns] = dictionary.encode(
+                values[index::num_columns])
+        key_index = self.properties.index(self.key)
+        make_row = partial(tuple.__new__, self._row_tuple)
+        self._store_rows(map(make_row, zip(*[iter(values)] * num_columns)),
+                         values[key_index::num_columns], duplicates, source)
+
+    def _store_rows(self, rows, keys: list = None,
+                    duplicates: str = 'last', source: str = ''):
+        """Add the rows to the row dictionary and the indexes. If the list
+        of keys is given, it must have the key of each row. See
+        load_files() for duplicates; source is the file name used in the
+        error for duplicates='error'. The cyclic garbage collector is
+        paused meanwhile as the rows cannot form reference cycles, but
+        would otherwise trigger collections that scan all the rows
+        loaded so far again and again."""
+        if keys is None:
+            key_index = self.properties.index(self.key)
+            pairs = ((row_value[key_index], row_value) for row_value in rows)
+        else:
+            pairs = zip(keys, rows)
+        if duplicates != 'last':
+            pairs = _new_keys(pairs, self._rows, duplicates, source)
+        indexes = [index for index in self._indexes.values() if index.built]
+        if len(indexes) > 0:
+            for index in indexes:
+                index.bind(self.properties)
+            pairs = _indexed_pairs(pairs, indexes)
+        enabled = gc.isenabled()
+        gc.disable()
+        try:
+            self._rows.update(pairs)
+        finally:
+            if enabled:
+                gc.enable()
+        self._dictionaries = {
+            name: dictionary for name, dictionary
+            in self._dictionaries.items() if not dictionary.overflowed}
+
+    def _set_encoding(self, encode_columns: (list or tuple),
+                      encode_threshold: int):
+        """Create the dictionaries for the columns to encode. Columns that
+        already have a dictionary keep it, so the codes do not change."""
+        for name in encode_columns:
+            _column_index(self.properties, name, 'property')
+            if name not in self._dictionaries:
+                self._dictionaries[name] = ColumnDictionary()
+        if encode_threshold > 0:
+            for name in self.properties:
+                if name not in self._dictionaries:
+                    self._dictionaries[name] = ColumnDictionary(
+                        encode_threshold)
+
+    def _encoders(self) -> list:
+        """Return the (column index, dictionary) tuples for the columns
+        that are encoded."""
+        return [(self.properties.index(name), dictionary)
+                for name, dictionary in self._dictionaries.items()
+                if not dictionary.overflowed]
+
+    @property
+    def dictionaries(self) -> dict:
+        """The ColumnDictionary of each dictionary encoded column."""
+        return self._dictionaries
+
+    def _dictionary(self, column: str) -> ColumnDictionary:
+        try:
+            return self._dictionaries[column]
+        except KeyError:
+            raise ValueError(f'The column "{column}" is not dictionary ' +
+                             'encoded - encoded columns: ' +
+                             f'{list(self._dictionaries)}') from None
+
+    def codes(self, column: str) -> array:
+        """Return the codes of a dictionary encoded column for the rows in
+        the order of rows."""
+        dictionary = self._dictionary(column)
+        index = self.properties.index(column)
+        if len(dictionary) <= 1 << 8:
+            typecode = 'B'
+        elif len(dictionary) <= 1 << 16:
+            typecode = 'H'
+        else:
+            typecode = 'L'
+        code = dictionary.codes.__getitem__
+        return array(typecode,
+                     [code(row[index]) for row in self._rows.values()])
+
+    def group_by(self, column: str) -> dict:
+        """Group the rows by the value of a column. Returns a dictionary
+        with the values as keys and the lists of rows as values. For a
+        dictionary encoded column, the values are the shared objects, so
+        each lookup is resolved by identity, and the groups are in the
+        order of the codes."""
+        index = _column_index(self.properties, column, 'property')
+        groups = {}
+        for row in self._rows.values():
+            groups.setdefault(row[index], []).append(row)
+        dictionary = self._dictionaries.get(column)
+        if dictionary is None:
+            return groups
+        return {value: groups[value] for value in dictionary.values
+                if value in groups}
+
+    def where(self, column: str, values) -> list:
+        """Return the rows where the column has the value or one of the
+        values if a set, list, or tuple is given. For a dictionary
+        encoded column, the values are replaced by the shared objects
+        first, so each comparison is resolved by identity."""
+        index = _column_index(self.properties, column, 'property')
+        if not isinstance(values, (set, frozenset, list, tuple)):
+            values = (values,)
+        dictionary = self._dictionaries.get(column)
+        if dictionary is not None:
+            values = [dictionary.shared(value) for value in values
+                      if value in dictionary]
+            if len(values) == 0:
+                return []
+        wanted = set(values)
+        return [row for row in self._rows.values() if row[index] in wanted]
+
+    def load_files(self, locations: list, glob: str = '*.csv', key: str = '',
+                   headers: (list or tuple) = (),
+                   properties: (list or tuple) = (),
+                   header_rows: int = 1, validate_headers: bool = False,
+                   encoding: str = 'utf-8-sig', delimiter: str = ',',
+                   quotechar: str = '"', require_column: str = '',
+                   filters: dict = None, filter_mode: str = 'and',
+                   workers: (int or None) = None, duplicates: str = 'last',
+                   encode_columns: (list or tuple) = (),
+                   encode_threshold: int = 0) -> dict:
+        """Load all the CSV files found by wistools.io.get_files() for the
+        locations and glob. The headers are read from the first file
+        (using the arguments as for load_file()), and every other file
+        must have the same header row. The files are parsed in a pool of
+        worker processes; workers defaults to the number of CPUs, and
+        with workers=1 the files are parsed in the current process.
+
+        The files are merged in the order of their paths. The duplicates
+        argument decides what happens when a key has already been
+        loaded: 'last' replaces the row, 'first' keeps the existing row,
+        and 'error' raises a ValueError.
+
+        Returns a dictionary with the error message for each file that
+        could not be loaded, for example because its headers differ."""
+        if duplicates not in ('last', 'first', 'error'):
+            raise ValueError(f'Unknown duplicates rule "{duplicates}" - ' +
+                             'supported rules: last, first, error')
+        files = sorted(get_files([str(location) for location in locations],
+                                 glob))
+        if len(files) == 0:
+            return {}
+
+        with open_file(files[0], 'rb') as binfile, \
+                _open_text(binfile, encoding) as csvfile:
+            reader = csv.reader(csvfile, delimiter=delimiter,
+                                quotechar=quotechar)
+            expected = self._read_headers(reader, headers, properties,
+                                          header_rows, validate_headers)
+        self._set_key(key)
+        self._set_encoding(encode_columns, encode_threshold)
+        # Check the filters before starting the workers
+        _compile_filters(filters, self.properties, filter_mode)
+        require_index = None
+        if require_column != '':
+            require_index = _column_index(self.headers, require_column,
+                                          'header')
+
+        num_files = len(files)
+        arguments = (files, [header_rows] * num_files,
+                     [expected] * num_files, [encoding] * num_files,
+                     [delimiter] * num_files, [quotechar] * num_files,
+                     [require_index] * num_files, [filters] * num_files,
+                     [filter_mode] * num_files,
+                     [self.properties] * num_files)
+        if workers == 1 or num_files < 2:
+            results = map(_load_file_values, *arguments)
+            executor = None
+        else:
+            if workers is None:
+                workers = cpu_count() or 1
+            executor = ProcessPoolExecutor(max_workers=workers)
+            # Keep at most two files per worker in flight, so the parsed
+            # files do not pile up in memory while they are merged
+            results = _bounded_map(executor, _load_file_values, arguments,
+                                   2 * workers)
+
+        errors = {}
+        try:
+            for file, (values, error) in zip(files, results):
+                if error is not None:
+                    errors[file] = error
+                    continue
+                self._store_values(values, duplicates, str(file))
+        finally:
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+
+        # refresh() only follows files loaded with load_file()
+        self._load_state = None
+        return errors
+
+    def write_file(self, path: (str or Path), rows=None,
+                   headers: (list or tuple or None) = None,
+                   encoding: str = 'utf-8', delimiter: str = ',',
+                   quotechar: str = '"', lineterminator: str = '\r\n',
+                   member: str = None) -> int:
+        """Write rows to a CSV file. The rows default to the rows of this
+        CsvDict, but can be any iterable of row tuples (or lists), for
+        example a generator from iter_file(), in which case the rows are
+        streamed to the file without holding them in memory. The header
+        row is written first; it defaults to the headers of this CsvDict
+        (after the first row has been read, so the headers from
+        iter_file() are available). Set headers to an empty list to
+        write no header row.
+
+        The file is opened with wistools.io.open_file(). The compression
+        is derived from the file name (.gz, .bz2, or .zip), and for a zip
+        file member is the name of the CSV file in the archive; it
+        defaults to the file name with .zip replaced with .csv. The
+        output goes through a large write buffer.
+
+        Returns the number of rows written."""
+        if rows is None:
+            rows = self._rows.values()
+        num_rows = len(rows) if isinstance(rows, Sized) else None
+        rows = iter(rows)
+        first = next(rows, None)
+        if headers is None:
+            headers = self.headers
         file = Path(path)
+        compression = _compression_for(file)
+        with open_file(file, 'wb', encoding=compression) as binfile, \
+                _open_text_writer(binfile, encoding, member or
+                                  _member_name(file)) as csvfile:
+            writer = csv.writer(csvfile, delimiter=delimiter,
+                                quotechar=quotechar,
+                                lineterminator=lineterminator)
+            if len(headers) > 0:
+                writer.writerow(headers)
+            if first is None:
+                return 0
+            writer.writerow(first)
+            if num_rows is not None:
+                writer.writerows(rows)
+                return num_rows
+            # Count the rows while writerows() consumes them
+            counter = count(1)
+            writer.writerows(row for row, _ in zip(rows, counter))
+            return next(counter)
+
+    def iter_file(self, path: (str or Path),
+                  headers: (list or tuple) = (),
+                  properties: (list or tuple) = (),
+                  header_rows: int = 1, validate_headers: bool = False,
+                  encoding: str = 'utf-8-sig', delimiter: str = ',',
+                  quotechar: str = '"', require_column: str = '',
+                  filters: dict = None, filter_mode: str = 'and',
+                  member: str = None):
+        """Iterate over the rows of a CSV file without storing them. The
+        rows are yielded as named tuples one at a time, so the memory
+        usage does not depend on the size of the file. The arguments
+        are the same as for load_file() except that there is no key.
+        The headers and properties are set when the iteration starts."""
+        with open_file(path, 'rb') as binfile, \
+                _open_text(binfile, encoding, member) as csvfile:
+            reader = csv.reader(csvfile, delimiter=delimiter,
+                                quotechar=quotechar)
+            self._read_headers(reader, headers, properties, header_rows,
+                               validate_headers)
+            yield from self._iter_rows(reader, require_column, filters,
+                                       filter_mode)
+
+    def _read_headers(self, reader, headers: (list or tuple),
+                      properties: (list or tuple), header_rows: int,
+                      validate_headers: bool):
+        """Read the header rows from the reader and set the headers,
+        properties, and row tuple. The last header row is used as the
+        headers unless headers are given. Blank lines are skipped.
+        Returns the last header row read from the file (None if there
+        are no header rows)."""
         if len(headers) > 0:
             self.headers = headers
         if len(properties) > 0:
             self.properties = properties
-        if key != '':
-            self.key = key
-        with file.open(mode='r', encoding=encoding) as csvfile:
-            # Check if the file starts with a byte order mark (BOM)
-            csvfile.seek(0)
-            i = 0
-            if len(self.headers) == 0:
-                # Read the headers from the file
-                reader = csv.reader(csvfile, delimiter=delimiter,
-                                    quotechar=quotechar)
-                for row in reader:
-                    i += 1
-                    if i == header_rows:
-                        self.headers = row
-                        break
-
-            if len(self.properties) > 0:
-                if len(self.properties) != len(self.headers):
-                    raise ValueError('The number of properties ' +
-                                     f'({len(self.properties)}) does not ' +
-                                     'match the number of headers ' +
-                                     f'{len(self.headers)}.')
+
+        header_row = _read_header_row(reader, header_rows)
+        if len(self.headers) == 0 and header_row is not None:
+            self.headers = header_row
+        elif validate_headers and header_row is not None:
+            # Validate that the read headers are the expected headers
+            _validate_headers(header_row, self.headers)
+
+        if len(self.properties) > 0:
+            if len(self.properties) != len(self.headers):
+                raise ValueError('The number of properties ' +
+                                 f'({len(self.properties)}) does not ' +
+                                 'match the number of headers ' +
+                                 f'{len(self.headers)}.')
+        else:
+            self.properties = _headers_to_properties(self.headers)
+
+        self._row_tuple = namedtuple(self._row_name, self.properties)
+        return header_row
+
+    def _iter_rows(self, reader, require_column: str,
+                   filters: (dict or None), filter_mode: str = 'and',
+                   last: (list or None) = None):
+        """Return an iterator over the row tuples for the remaining rows
+        of the reader. The rows are checked against require_column and
+        the filters while they are still lists of strings, so rejected
+        rows never become tuples. Rows with fewer values than there are
+        headers are padded with None. If last is given, its first item
+        is set to each row read (see _filter_rows())."""
+        num_columns = len(self.properties)
+        require_index = None
+        if require_column != '':
+            require_index = _column_index(self.headers, require_column,
+                                          'header')
+        predicate = _compile_filters(filters, self.properties,
+                                     filter_mode)
+        rows = _filter_rows(reader, num_columns, require_index, predicate,
+                            last)
+        encoders = self._encoders()
+        if len(encoders) > 0:
+            rows = _encode_rows(rows, encoders, num_columns)
+        return map(self._row_tuple._make, rows)
+
+    def _load_ranges(self, path: Path, start: int, end: int, quote: bytes,
+                     encoding: str, delimiter: str, quotechar: str,
+                     require_column: str, filters: (dict or None),
+                     filter_mode: str, workers: int):
+        """Yield the values of the rows between the byte offsets start
+        and end. The data is split into byte ranges that are
+        parsed by _load_range() in a pool of worker processes, and the
+        values of each range are yielded as one flat list together with
+        the last record of the range in the order of the ranges."""
+        require_index = None
+        if require_column != '':
+            require_index = _column_index(self.headers, require_column,
+                                          'header')
+        # Check the filters before starting the workers
+        _compile_filters(filters, self.properties, filter_mode)
+        with path.open(mode='rb') as binfile, \
+                mmap(binfile.fileno(), 0, access=ACCESS_READ) as data:
+            # More ranges than workers to even out the work
+            offsets = _split_offsets(data, start, end, quote, workers * 4)
+
+        num_ranges = len(offsets) - 1
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = executor.map(
+                _load_range, [path] * num_ranges, offsets[:-1], offsets[1:],
+                [encoding] * num_ranges, [delimiter] * num_ranges,
+                [quotechar] * num_ranges,
+                [len(self.properties)] * num_ranges,
+                [require_index] * num_ranges, [filters] * num_ranges,
+                [filter_mode] * num_ranges,
+                [self.properties] * num_ranges)
+            yield from results
+
+
+def _read_header_row(reader, header_rows: int) -> (list or None):
+    """Read the header rows skipping blank lines and return the last."""
+    header_row = None
+    i = 0
+    while i < header_rows:
+        header_row = next(reader, None)
+        if header_row is None:
+            break
+        if len(header_row) > 0:
+            i += 1
+    return header_row
+
+
+def _bounded_map(executor: ProcessPoolExecutor, function, arguments: tuple,
+                 limit: int):
+    """Like executor.map(), but with at most limit calls submitted and
+    not yet consumed at a time."""
+    pending = deque()
+    for call_arguments in zip(*arguments):
+        pending.append(executor.submit(function, *call_arguments))
+        if len(pending) >= limit:
+            yield pending.popleft().result()
+    while len(pending) > 0:
+        yield pending.popleft().result()
+
+
+def _load_file_values(file: Path, header_rows: int, expected: (list or None),
+                      encoding: str, delimiter: str, quotechar: str,
+                      require_index: (int or None), filters: (dict or None),
+                      filter_mode: str, properties: list) -> tuple:
+    """Parse a CSV file after checking that its header row is the same
+    as expected (the header row of the first file as read).
+    Returns a tuple with the values of all the rows as one flat list and
+    the error message (None on success). This is the worker function
+    for CsvDict.load_files()."""
+    num_columns = len(properties)
+    values = []
+    try:
+        with open_file(file, 'rb') as binfile, \
+                _open_text(binfile, encoding) as csvfile:
+            reader = csv.reader(csvfile, delimiter=delimiter,
+                                quotechar=quotechar)
+            header_row = _read_header_row(reader, header_rows)
+            if expected is not None:
+                if header_row is None:
+                    raise ValueError('The file has no header row.')
+                if header_row != expected:
+                    raise ValueError(f'The header row {header_row} ' +
+                                     'differs from the header row ' +
+                                     f'{expected} of the first file.')
+            predicate = _compile_filters(filters, properties, filter_mode)
+            for row in _filter_rows(reader, num_columns, require_index,
+                                    predicate):
+                if len(row) != num_columns:
+                    raise ValueError(f'Expected {num_columns} values, ' +
+                                     f'got {len(row)}: {row}')
+                values.extend(row)
+    except Exception as err:
+        return [], f'{type(err).__name__}: {err}'
+    return values, None
+
+
+def _filter_rows(reader, num_columns: int, require_index: (int or None),
+                 predicate, last: (list or None) = None):
+    """Yield the rows of the reader as lists of strings skipping blank
+    lines, rows without a value in the require_index column, and rows
+    not matching the predicate. Short rows are padded with None. If
+    last is given, its first item is set to each row read, skipped or
+    not, so it ends with the last record of the reader."""
+    if last is None:
+        last = [None]
+    for row in reader:
+        last[0] = row
+        if len(row) != num_columns:
+            if len(row) == 0:
+                # Blank line
+                continue
+            if len(row) < num_columns:
+                row += [None] * (num_columns - len(row))
+        if require_index is not None and row[require_index] == '':
+            # The row with totals - ignore that
+            continue
+        if predicate is not None and not predicate(row):
+            continue
+        yield row
+
+
+def _zip_member(archive: ZipFile, member: (str or None)) -> str:
+    """Return the name of the member to read from a zip archive. Without
+    a member name, the archive must have a single file or a single file
+    with the .csv extension."""
+    names = [info.filename for info in archive.infolist()
+             if not info.is_dir()]
+    if member is not None:
+        if member not in names:
+            raise ValueError(f'The zip archive has no member "{member}" ' +
+                             f'- members: {names}')
+        return member
+    if len(names) != 1:
+        names_csv = [name for name in names
+                     if name.lower().endswith('.csv')]
+        if len(names_csv) != 1:
+            raise ValueError('Specify which member of the zip archive to ' +
+                             f'read - members: {names}')
+        names = names_csv
+    return names[0]
+
+
+def _compression_for(file: Path) -> (str or None):
+    """Return the compression type for wistools.io.open_file() based on
+    the file name."""
+    if file.suffix.lower() == '.zip':
+        return 'zip'
+    compression = guess_type(file, False)[1]
+    if compression in ('gzip', 'bzip2'):
+        return compression
+    return None
+
+
+def _member_name(file: Path) -> str:
+    """Return the default member name in a zip archive for a CSV file."""
+    if file.suffix.lower() == '.zip':
+        name = file.stem
+        if not name.lower().endswith('.csv'):
+            name += '.csv'
+        return name
+    return file.name
+
+
+@contextmanager
+def _open_text_writer(binfile, encoding: str, member: str):
+    """Open a binary file returned by wistools.io.open_file() for writing
+    text with the csv module. The output is collected in a large buffer,
+    so the compressor and the file get big blocks at a time. For a zip
+    archive, the member file is created."""
+    if isinstance(binfile, ZipFile):
+        binfile = binfile.open(member, mode='w', force_zip64=True)
+    binfile = BufferedWriter(binfile, _WRITE_BUFFER_SIZE)
+    textfile = TextIOWrapper(binfile, encoding=encoding, newline='')
+    try:
+        yield textfile
+    finally:
+        textfile.close()
+
+
+@contextmanager
+def _open_text(binfile, encoding: str, member: (str or None) = None):
+    """Open a binary file returned by wistools.io.open_file() as text for
+    the csv module. The decompressed data is read through a large
+    buffer, so the decompressor works on big blocks at a time. For a zip
+    archive, the member file is opened."""
+    if isinstance(binfile, ZipFile):
+        binfile = binfile.open(_zip_member(binfile, member))
+    if not isinstance(binfile, BufferedReader):
+        binfile = BufferedReader(binfile, _READ_BUFFER_SIZE)
+    textfile = TextIOWrapper(binfile, encoding=encoding, newline='')
+    try:
+        yield textfile
+    finally:
+        textfile.close()
+
+
+def _cache_path(file: Path, cache: (bool or Path or str),
+                digest: bytes) -> Path:
+    """Return the path of the cache file for a CSV file loaded with the
+    arguments in the digest. The cache file is next to the CSV file if
+    cache is True and otherwise in the cache directory. The name
+    includes the start of the digest, so loads with different arguments
+    have separate cache files."""
+    name = f'{file.name}-{digest[:8].hex()}{CACHE_SUFFIX}'
+    if cache is True:
+        return file.with_name(name)
+    return Path(cache) / name
+
+
+def _stable_form(value) -> (str or None):
+    """Return a representation of an argument value that is the same in
+    every run, or None if there is no such representation. The repr() of
+    a set depends on the hash seed, so the elements are sorted, and
+    functions are represented by their qualified name unless they are
+    lambdas or local functions."""
+    if value is None or isinstance(value, (str, bytes, int, float)):
+        return repr(value)
+    if isinstance(value, (list, tuple, set, frozenset, dict)):
+        items = value.items() if isinstance(value, dict) else value
+        forms = [_stable_form(item) for item in items]
+        if None in forms:
+            return None
+        if isinstance(value, (set, frozenset, dict)):
+            forms.sort()
+        return f'{type(value).__name__}({", ".join(forms)})'
+    if isinstance(value, re.Pattern):
+        return f're.compile({value.pattern!r}, {value.flags})'
+    if isinstance(value, Range):
+        forms = [_stable_form(item)
+                 for item in (value.low, value.high, value.convert)]
+        return None if None in forms else f'Range({", ".join(forms)})'
+    qualname = getattr(value, '__qualname__', None)
+    if qualname is not None:
+        if '<' in qualname:
+            # A lambda or a local function
+            return None
+        module = getattr(value, '__module__', None) or \
+            getattr(getattr(value, '__self__', None), '__module__', None)
+        return f'{module}.{qualname}'
+    form = repr(value)
+    return None if ' at 0x' in form else form
+
+
+def _arguments_digest(file: Path, row_name: str,
+                      arguments: dict) -> (bytes or None):
+    """Return a digest of the path and the arguments that change the
+    parsed rows, or None if an argument has no stable form (see
+    _stable_form()). The Python version is included as the cache uses
+    the marshal format."""
+    ignored = ('path', 'key', 'workers', 'encode_columns',
+               'encode_threshold', 'cache')
+    forms = sorted((name, _stable_form(value)) for name, value
+                   in arguments.items() if name not in ignored)
+    if any(form is None for _, form in forms):
+        return None
+    key = repr((str(file.resolve()), row_name, sys.version_info[:2],
+                marshal.version, forms))
+    return blake2b(key.encode('utf-8'), digest_size=32).digest()
+
+
+def _read_cache(cache_file: Path, stat, digest: bytes) -> (tuple or None):
+    """Return the (headers, properties, values, last_row) tuple from a
+    cache file or None if there is no cache or it is out of date. The
+    last_row is the last record read as a list of strings (None if
+    there were no rows)."""
+    try:
+        with cache_file.open(mode='rb') as cache_fd:
+            header = cache_fd.read(_CACHE_HEADER.size)
+            if len(header) != _CACHE_HEADER.size or \
+                    _CACHE_HEADER.unpack(header) != (
+                        _CACHE_MAGIC, stat.st_size, stat.st_mtime_ns,
+                        digest):
+                return None
+            return marshal.loads(cache_fd.read())
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+
+
+def _write_cache(cache_file: Path, file: Path, stat, digest: bytes,
+                 payload: tuple):
+    """Write the parsed headers, properties, row values, and last record
+    to a cache file. The cache is not written if the CSV file changed
+    while it was parsed."""
+    current = file.stat()
+    if (current.st_size, current.st_mtime_ns) != \
+            (stat.st_size, stat.st_mtime_ns):
+        return
+    data = marshal.dumps((list(payload[0]), list(payload[1]), payload[2],
+                          payload[3]))
+    # A concurrent load never sees a partial cache. Failing to write the
+    # cache is not an error.
+    try:
+        with atomic_write(cache_file) as cache_fd:
+            cache_fd.write(_CACHE_HEADER.pack(
+                _CACHE_MAGIC, stat.st_size, stat.st_mtime_ns, digest))
+            cache_fd.write(data)
+    except OSError:
+        pass
+
+
+def _last_record_end(data: bytes, quote: bytes) -> int:
+    """Return the offset just after the last complete record in data,
+    which must start at a record boundary. That is the last newline
+    preceded by an even number of quote characters."""
+    if data.endswith(b'\n') and data.count(quote) % 2 == 0:
+        return len(data)
+    end = 0
+    position = 0
+    quotes = 0
+    while True:
+        newline = data.find(b'\n', position)
+        if newline < 0:
+            return end
+        quotes += data.count(quote, position, newline)
+        position = newline + 1
+        if quotes % 2 == 0:
+            end = position
+
+
+def _resume_offset(binfile, last_row: (list or None), encoding: str,
+                   delimiter: str, quotechar: str) -> tuple:
+    """Return (offset, complete) for a plain file that has been parsed to
+    the end. The offset is the end of the file if the last record is
+    complete, otherwise the start of the last record, and None if that
+    cannot be found. The last record is complete if the file ends with
+    a newline and the record parses in strict mode, which fails on an
+    open quoted field. The last_row is the last record as parsed (None
+    if there were no rows after the headers). Each newline in its values
+    is a newline in the record, so the start is found by counting
+    newlines back from the end of the file, and checked by parsing the
+    record from there."""
+    size = binfile.seek(0, SEEK_END)
+    if size == 0:
+        return 0, True
+    binfile.seek(size - 1)
+    newline_end = binfile.read(1) == b'\n'
+    if last_row is None:
+        return (size if newline_end else None), newline_end
+    row = [value for value in last_row if value is not None]
+    newlines = 1 + sum(value.count('\n') for value in row)
+    # The newline at the end of the file ends the record, unless it is
+    # in an open quoted field and so already counted
+    for number in (newlines + 1, newlines) if newline_end else (newlines,):
+        start = _newline_offset(binfile, size, number)
+        if start is None:
+            continue
+        binfile.seek(start)
+        try:
+            text = binfile.read(size - start).decode(encoding)
+        except UnicodeDecodeError:
+            continue
+        if list(csv.reader(StringIO(text, newline=''), delimiter=delimiter,
+                           quotechar=quotechar)) != [row]:
+            continue
+        if not newline_end:
+            return start, False
+        try:
+            for _ in csv.reader(StringIO(text, newline=''),
+                                delimiter=delimiter, quotechar=quotechar,
+                                strict=True):
+                pass
+        except csv.Error:
+            return start, False
+        return size, True
+    return None, False
+
+
+def _newline_offset(binfile, end: int, count: int) -> (int or None):
+    """Return the offset just after the count-th newline before the byte
+    offset end of a binary file, where the start of the file counts as
+    the last one, or None if there are fewer newlines. The file is read
+    backwards a block at a time."""
+    block_end = end
+    while block_end > 0:
+        block_start = max(0, block_end - _TAIL_BLOCK_SIZE)
+        binfile.seek(block_start)
+        block = binfile.read(block_end - block_start)
+        position = len(block)
+        while True:
+            position = block.rfind(b'\n', 0, position)
+            if position < 0:
+                break
+            count -= 1
+            if count == 0:
+                return block_start + position + 1
+        block_end = block_start
+    return 0 if count == 1 else None
+
+
+def _decoded_lines(binfile, encoding: str):
+    """Yield the decoded lines of a binary file reading one line at a
+    time, so the file position is at the end of the last yielded line."""
+    decoder = getincrementaldecoder(encoding)()
+    for line in iter(binfile.readline, b''):
+        yield decoder.decode(line)
+
+
+def _quote_byte(encoding: str, quotechar: str) -> (bytes or None):
+    """Return the encoded quote character if the newline and quote
+    characters are encoded as single bytes in the encoding, otherwise
+    None."""
+    try:
+        quote = quotechar.encode('ascii')
+    except UnicodeEncodeError:
+        return None
+    if len(quote) != 1 or \
+            not ('\n' + quotechar).encode(encoding).endswith(b'\n' + quote):
+        return None
+    return quote
+
+
+def _split_offsets(data, start: int, end: int, quote: bytes,
+                   parts: int) -> list:
+    """Return the byte offsets splitting data from start to end into up
+    to parts ranges at record boundaries. A newline ends a record when
+    it is preceded by an even number of quote characters counting from
+    start, so newlines inside quoted fields are never used. The first
+    offset is start and the last is end."""
+    size = end
+    offsets = [start]
+    position = start
+    quotes = 0
+    for part in range(1, parts):
+        target = max(position, start + (size - start) * part // parts)
+        while True:
+            newline = data.find(b'\n', target, size)
+            if newline < 0:
+                break
+            quotes += data[position:newline].count(quote)
+            position = newline + 1
+            if quotes % 2 == 0:
+                break
+            target = position
+        if newline < 0:
+            break
+        if position < size and position > offsets[-1]:
+            offsets.append(position)
+    offsets.append(size)
+    return offsets
+
+
+def _load_range(path: Path, start: int, end: int, encoding: str,
+                delimiter: str, quotechar: str, num_columns: int,
+                require_index: (int or None), filters: (dict or None),
+                filter_mode: str, properties: list) -> tuple:
+    """Parse the rows between the byte offsets start and end of a CSV
+    file. Returns the values of all the rows as one flat list, which is
+    much faster to send back to the parent process than a list per row,
+    and the last record read (None if there were no records). This is
+    the worker function for CsvDict.load_file() with workers."""
+    with path.open(mode='rb') as binfile:
+        binfile.seek(start)
+        text = binfile.read(end - start).decode(encoding)
+    reader = csv.reader(StringIO(text, newline=''), delimiter=delimiter,
+                        quotechar=quotechar)
+    predicate = _compile_filters(filters, properties, filter_mode)
+    values = []
+    last = [None]
+    for row in _filter_rows(reader, num_columns, require_index, predicate,
+                            last):
+        if len(row) != num_columns:
+            raise TypeError(f'Expected {num_columns} values, got ' +
+                            f'{len(row)}: {row}')
+        values.extend(row)
+    return values, last[0]
+
+
+def _float_or_nan(value) -> float:
+    """Convert a value to a float with missing values (None or an empty
+    string) as NaN."""
+    if value is None or value == '':
+        return nan
+    return float(value)
+
+
+def _convert_column(values: tuple, column_type: type):
+    """Convert the raw values of a column to column_type. Integer and
+    float columns are returned as arrays, string columns as lists of
+    interned strings. Raises ValueError if a value cannot be
+    converted."""
+    if column_type is str:
+        intern = sys.intern
+        return [None if v is None else intern(v) for v in values]
+    if column_type is int:
+        return array('q', map(int, values))
+    try:
+        return array('d', map(float, values))
+    except (TypeError, ValueError):
+        # There may be missing values
+        return array('d', map(_float_or_nan, values))
+
+
+def _infer_column(values: tuple, column_type: (type or None)):
+    """Convert the raw values of a column with an inferred type. The
+    type starts as the narrowest of int, float, and str that is at least
+    as wide as column_type and is widened until all the values can be
+    converted. Returns the type and the converted values."""
+    types = (int, float, str)
+    start = 0 if column_type is None else types.index(column_type)
+    for candidate in types[start:]:
+        try:
+            return candidate, _convert_column(values, candidate)
+        except (TypeError, ValueError, OverflowError):
+            pass
+
+
+def _widen_column(column, column_type: type):
+    """Convert an already loaded numeric column to a wider numeric
+    type."""
+    return array(_COLUMN_TYPECODES[column_type], column)
+
+
+class CsvColumns(object):
+    """A CSV file stored column by column. Integer and float columns are
+    stored in arrays of 64-bit values and string columns as lists of
+    interned strings, which uses much less memory than a CsvDict with a
+    tuple of strings per row for large files with numeric data.
+
+    The type of each column is either declared with the types argument
+    of load_file() (int, float, or str) or inferred from the values. An
+    inferred column starts as int and is widened to float and then str
+    as needed. Missing values in float columns are stored as NaN, so
+    an inferred integer column with missing values becomes a float
+    column. If a column inferred as numeric turns out to hold text, the
+    values already loaded are read again from the files, so the column
+    keeps the original text."""
+    _row_name: str = 'CsvRow'
+    _row_tuple: namedtuple = None
+    _headers: list = []
+    _properties: list = []
+    _types: dict = {}
+    _columns: dict = {}
+    _length: int = 0
+    _sources: list = []  # (path, iter_file() arguments, rows) per file
+
+    def __init__(self, row_name: str = 'CsvRow'):
+        self._row_name = row_name
+        self._row_tuple = namedtuple(row_name, [])
+        self._headers = []
+        self._properties = []
+        self._types = {}
+        self._columns = {}
+        self._length = 0
+        self._sources = []
+
+    @property
+    def headers(self) -> list:
+        return self._headers
+
+    @property
+    def properties(self) -> list:
+        return self._properties
+
+    @property
+    def types(self) -> dict:
+        """The type of each column as a dictionary with the property
+        names as keys."""
+        return dict(self._types)
+
+    @property
+    def columns(self) -> dict:
+        return self._columns
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __getitem__(self, name: str) -> (array or list):
+        return self.column(name)
+
+    def column(self, name: str) -> (array or list):
+        """Return a column as an array (int and float columns) or a
+        list (str columns)."""
+        try:
+            return self._columns[name]
+        except KeyError:
+            raise ValueError(f'No column exists with the name "{name}" ' +
+                             f'- properties: {self._properties}') from None
+
+    def row(self, index: int) -> tuple:
+        """Return a single row as a named tuple with typed values."""
+        return self._row_tuple._make(
+            self._columns[name][index] for name in self._properties)
+
+    def to_numpy(self, name: str) -> 'np.ndarray':
+        """Return a numeric column as a NumPy array sharing the memory of
+        the column. Requires NumPy."""
+        if np is None:
+            raise ImportError('to_numpy() requires NumPy.')
+        column = self.column(name)
+        if not isinstance(column, array):
+            raise ValueError(f'The column "{name}" is not numeric.')
+        dtype = np.int64 if column.typecode == 'q' else np.float64
+        return np.frombuffer(column, dtype=dtype)
+
+    def sum(self, name: str) -> (int or float):
+        """Return the sum of a numeric column. Float columns are summed
+        with NumPy if it is available and otherwise with math.fsum()."""
+        column = self.column(name)
+        if not isinstance(column, array):
+            raise ValueError(f'The column "{name}" is not numeric.')
+        if column.typecode == 'q':
+            return sum(column)
+        if np is not None:
+            return float(self.to_numpy(name).sum())
+        return fsum(column)
+
+    def mean(self, name: str) -> float:
+        """Return the mean of a numeric column."""
+        if self._length == 0:
+            return nan
+        return self.sum(name) / self._length
+
+    def load_file(self, path: (str or Path), types: dict = None,
+                  headers: (list or tuple) = (),
+                  properties: (list or tuple) = (),
+                  header_rows: int = 1, validate_headers: bool = False,
+                  encoding: str = 'utf-8-sig', delimiter: str = ',',
+                  quotechar: str = '"', require_column: str = '',
+                  filters: dict = None, filter_mode: str = 'and',
+                  chunk_size: int = 65536, member: str = None):
+        """Load the content of a CSV file into typed columns. The types
+        argument is a dictionary with property names as keys and int,
+        float, or str as the values. The types of the other columns are
+        inferred. The rest of the arguments are the same as for
+        CsvDict.load_file(). The rows are converted chunk_size rows at a
+        time. Loading another file appends to the columns; the file must
+        have the same properties, but they can be in another order.
+        """
+        arguments = {
+            'headers': headers, 'properties': properties,
+            'header_rows': header_rows,
+            'validate_headers': validate_headers, 'encoding': encoding,
+            'delimiter': delimiter, 'quotechar': quotechar,
+            'require_column': require_column, 'filters': filters,
+            'filter_mode': filter_mode, 'member': member,
+        }
+        reader = CsvDict(self._row_name)
+        rows = reader.iter_file(path, **arguments)
+        declared = {} if types is None else dict(types)
+        loaded = 0
+        order = None
+        try:
+            while True:
+                chunk = list(islice(rows, chunk_size))
+                if len(self._properties) == 0:
+                    self._start(reader, declared)
+                if order is None:
+                    order = self._column_order(reader.properties, path)
+                if len(chunk) == 0:
+                    break
+                self._add_chunk(chunk, declared,
+                                self._sources + [(path, arguments, loaded)],
+                                order)
+                loaded += len(chunk)
+        finally:
+            if loaded > 0:
+                self._sources.append((path, arguments, loaded))
+
+    def _start(self, reader: CsvDict, declared: dict):
+        """Set up the columns from the headers of the first file."""
+        for name, column_type in declared.items():
+            _column_index(reader.properties, name, 'property')
+            if column_type not in (int, float, str):
+                raise ValueError(f'Unsupported type {column_type!r} for ' +
+                                 f'the column "{name}" - supported ' +
+                                 'types: int, float, str')
+        self._headers = list(reader.headers)
+        self._properties = list(reader.properties)
+        self._row_tuple = namedtuple(self._row_name, self._properties)
+        for name in self._properties:
+            column_type = declared.get(name)
+            self._types[name] = column_type
+            if column_type is str:
+                self._columns[name] = []
+            elif column_type is not None:
+                self._columns[name] = array(_COLUMN_TYPECODES[column_type])
+
+    def _column_order(self, properties: list, path: (str or Path)) -> list:
+        """Return the position in the rows of a file with the properties
+        of each of the columns. Raises ValueError if the file does not
+        have the same properties as the columns."""
+        if sorted(properties) != sorted(self._properties):
+            raise ValueError(f'The properties {list(properties)} of ' +
+                             f'"{path}" differ from the properties ' +
+                             f'{self._properties} of the columns.')
+        return [properties.index(name) for name in self._properties]
+
+    def _read_column(self, name: str, sources: list) -> list:
+        """Read the raw values of a column for the rows already loaded
+        from the files again."""
+        get_value = attrgetter(name)
+        values = []
+        for path, arguments, length in sources:
+            rows = CsvDict(self._row_name).iter_file(path, **arguments)
+            values.extend(map(get_value, islice(rows, length)))
+        if len(values) != self._length:
+            raise ValueError(f'Cannot convert the column "{name}" to str: ' +
+                             f'expected {self._length} rows when reading ' +
+                             f'the files again, got {len(values)}')
+        return values
+
+    def _add_chunk(self, chunk: list, declared: dict, sources: list,
+                   order: list):
+        """Convert and add a chunk of rows. The sources are the files the
+        rows already in the columns were loaded from, and order is the
+        position in the rows of each column. All the columns are
+        converted before any of them is changed, so a value that cannot
+        be converted leaves the columns as they were."""
+        values_by_position = list(zip(*chunk))
+        updates = []
+        for name, position in zip(self._properties, order):
+            values = values_by_position[position]
+            column_type = self._types[name]
+            column = self._columns.get(name)
+            if name in declared:
+                try:
+                    converted = _convert_column(values, column_type)
+                except (TypeError, ValueError, OverflowError) as error:
+                    raise ValueError(f'The column "{name}" has a value ' +
+                                     'that cannot be converted to ' +
+                                     f'{column_type.__name__}: ' +
+                                     f'{error}') from None
             else:
-                self.properties = _headers_to_properties(self.headers)
-
-            if self.key == '':
-                # Use the first property as the key
-                self.key = self.properties[0]
-
-            self._row_tuple = namedtuple(self._row_name, self.properties)
-
-            csvfile.seek(0)
-            i = 0
-            reader = csv.DictReader(csvfile, self.headers, delimiter=delimiter,
-                                    quotechar=quotechar)
-            for row in reader:
-                i += 1
-                if i == header_rows and validate_headers:
-                    # Validate that the read headers are the expected headers
-                    # This is trivial if the headers were read from the file
-                    _validate_headers(row, self.headers)
-                elif i <= header_rows:
-                    continue
-                else:
-                    if require_column != '' and row[require_column] == '':
-                        # The row with totals - ignore that
-                        continue
-
-                    row_value = self._row_tuple(*row.values())
-                    include = True
-                    if filters is not None:
-                        for key, filter_value in filters.items():
-                            value = getattr(row_value, key)
-                            if value != filter_value:
-                                include = False
-
-                    if include:
-                        key_value = getattr(row_value, self.key)
-                        self._rows[key_value] = row_value
+                inferred, converted = _infer_column(values, column_type)
+                if column_type is None:
+                    column = None
+                elif inferred is str and column_type is not str:
+                    # str() of the converted numbers would change the
+                    # text (for example 007 or 5.0), so the raw values
+                    # are read from the files again.
+                    column = _convert_column(
+                        self._read_column(name, sources), str)
+                elif inferred is not column_type:
+                    column = _widen_column(column, inferred)
+                column_type = inferred
+            updates.append((name, column_type, column, converted))
+
+        for name, column_type, column, converted in updates:
+            if column is None:
+                column = converted
+            else:
+                column += converted
+            self._columns[name] = column
+            self._types[name] = column_type
+        self._length += len(chunk)
@@ -1,33 +1,747 @@
+from array import array
+from hashlib import blake2b
+from io import BytesIO
+import json
+from mmap import ACCESS_READ, mmap
+import struct
+import sys
+from collections import namedtuple
+from collections.abc import Sequence
+from concurrent.futures import ProcessPoolExecutor
+from heapq import heapify, heappop, heappush
+from itertools import accumulate
+from math import (asin, atan, cos, degrees, floor, fsum, inf, radians, sin,
+                  sqrt)
+from operator import methodcaller
 from pathlib import Path
 import xml.etree.ElementTree as ElementTree
-from zipfile import ZipFile
+from xml.sax.saxutils import XMLGenerator
+from zipfile import ZIP_DEFLATED, ZipFile
+
+from .io import atomic_write, get_files
+
+# NumPy is optional. When it is installed, the packed coordinates can be
+# exposed as NumPy arrays without copying them.
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 NS_KML = '{http://www.opengis.net/kml/2.2}'
 
+# The mean Earth radius (metres) used for spherical calculations and the
+# WGS 84 ellipsoid parameters used for ellipsoidal calculations.
+EARTH_RADIUS = 6371008.8
+WGS84_A = 6378137.0
+WGS84_F = 1 / 298.257223563
+
+# The binary cache files used by Kml.load() and Kmz.load(). The header
+# holds the magic, the size, modification time, and digest of the source
+# file, and the length of the JSON metadata.
+CACHE_SUFFIX = '.wiscache'
+_CACHE_MAGIC = b'WISKML03'
+_CACHE_HEADER = struct.Struct('<8sQq32sQ')
+
+# Well-known binary (WKB) geometry types with Z coordinates (ISO 19125)
+# and the header (byte order, type, and count) in the native byte order,
+# so the packed coordinates can be written as they are.
+WKB_POINT_Z = 1001
+WKB_LINESTRING_Z = 1002
+WKB_POLYGON_Z = 1003
+WKB_GEOMETRYCOLLECTION_Z = 1007
+_WKB_BYTE_ORDER = 1 if sys.byteorder == 'little' else 0
+_WKB_HEADER = struct.Struct('=BI')
+_WKB_COUNT = struct.Struct('=I')
+
 
 def _kml_text(element: ElementTree.Element, tag: str) -> str:
     """Return the text of a tag of the given element."""
     return element.find(f'./{NS_KML}{tag}').text.strip()
 
 
-def _parse_kml_object(self, tree: ElementTree.Element):
-    if tree.tag == 'Document':
+def _local_name(tag: str) -> str:
+    """Return the tag name without the namespace."""
+    return tag.rpartition('}')[2]
+
+
+def _child(element: ElementTree.Element, name: str):
+    """Return the first child with the given local name (ignoring the
+    namespace) or None if there is no such child."""
+    for child in element:
+        if _local_name(child.tag) == name:
+            return child
+    return None
+
+
+def _child_text(element: ElementTree.Element, name: str) -> (str or None):
+    """Return the stripped text of the first child with the given local
+    name or None if the child does not exist."""
+    child = _child(element, name)
+    if child is None or child.text is None:
+        return None
+    return child.text.strip()
+
+
+def _parse_coordinates(text: str) -> array:
+    """Parse the KML coordinates format (whitespace separated
+    lon,lat[,alt] tuples) into a packed array of doubles with three
+    values (longitude, latitude, altitude) per coordinate. The altitude
+    defaults to 0."""
+    tuples = text.split()
+    commas = set(map(methodcaller('count', ','), tuples))
+    if commas == {2} or commas == {1}:
+        # All the coordinates have the same number of components, so the
+        # values can be converted in one go unless a component is empty.
+        components = commas.pop() + 1
+        fields = text.replace(',', ' ').split()
+        if len(fields) == components * len(tuples):
+            values = array('d', map(float, fields))
+            if components == 3:
+                return values
+            # No coordinates include the altitude.
+            packed = array('d', bytes(values.itemsize * 3 * len(tuples)))
+            packed[0::3] = values[0::2]
+            packed[1::3] = values[1::2]
+            return packed
+
+    packed = array('d')
+    for coordinate in tuples:
+        components = coordinate.split(',')
+        if len(components) == 2:
+            packed.extend((float(components[0]), float(components[1]), 0.0))
+        elif len(components) == 3:
+            packed.extend(map(float, components))
+        else:
+            raise ValueError(f'Invalid coordinate: "{coordinate}"')
+    return packed
+
+
+def _parse_polygon(element: ElementTree.Element) -> 'Polygon':
+    """Create a Polygon from a KML Polygon element."""
+    polygon = Polygon()
+    for boundary in element:
+        tag = _local_name(boundary.tag)
+        if tag not in ('outerBoundaryIs', 'innerBoundaryIs'):
+            continue
+        for ring in boundary:
+            if _local_name(ring.tag) != 'LinearRing':
+                continue
+            coordinates = _child_text(ring, 'coordinates')
+            if coordinates is None:
+                continue
+            if tag == 'outerBoundaryIs':
+                polygon.set_outer_boundary_from_text(coordinates)
+            else:
+                polygon.add_inner_boundary_from_text(coordinates)
+    return polygon
+
+
+def _parse_placemark(placemark: ElementTree.Element):
+    """Create the geometry (LineString, Polygon, or Point) for a
+    Placemark element. Returns None if the placemark does not contain a
+    supported geometry."""
+    geometry = None
+    line_string = _child(placemark, 'LineString')
+    if line_string is not None:
+        geometry = LineString()
+        coordinates = _child_text(line_string, 'coordinates')
+        if coordinates is not None:
+            geometry.add_coordinates_from_text(coordinates)
+    elif _child(placemark, 'Polygon') is not None:
+        geometry = _parse_polygon(_child(placemark, 'Polygon'))
+    else:
+        point = _child(placemark, 'Point')
+        if point is not None:
+            coordinates = _child_text(point, 'coordinates')
+            if coordinates is not None:
+                geometry = Point(*_parse_coordinates(coordinates)[0:3])
+            else:
+                geometry = Point()
+
+    if geometry is not None:
+        geometry.name = _child_text(placemark, 'name')
+        geometry.description = _child_text(placemark, 'description')
+        geometry.style_url = _child_text(placemark, 'styleUrl')
+
+    return geometry
+
+
+def _iter_placemarks(source, document: 'KmlDocument' = None):
+    """Incrementally parse the KML document in source (a file name or
+    file object) and yield a (folders, geometry) tuple for each
+    placemark as soon as the placemark has been read. folders is a tuple
+    with the names of the folders containing the placemark. If a
+    document is given, the shared styles are added to it as they are
+    read.
+
+    Elements are removed from the tree once they have been handled, so
+    the memory usage does not depend on the size of the document."""
+    folders = []
+    parents = []
+    for event, element in ElementTree.iterparse(source,
+                                                events=('start', 'end')):
+        tag = _local_name(element.tag)
+        if event == 'start':
+            if tag == 'Folder':
+                folders.append('')
+            parents.append(element)
+            continue
+
+        parents.pop()
+        parent = parents[-1] if len(parents) > 0 else None
+        parent_tag = _local_name(parent.tag) if parent is not None else None
+        if tag == 'Placemark':
+            geometry = _parse_placemark(element)
+            if geometry is not None:
+                yield tuple(folders), geometry
+        elif tag == 'Folder':
+            folders.pop()
+        elif tag == 'name' and parent_tag == 'Folder':
+            folders[-1] = (element.text or '').strip()
+        elif document is not None and parent_tag in ('Document', 'Folder'):
+            if tag == 'Style':
+                style = KmlStyle()
+                style.parse(element)
+                document.add_style(style)
+            elif tag == 'StyleMap':
+                style_map = KmlStyleMap()
+                style_map.parse(element)
+                document.add_style(style_map)
+            elif tag == 'name' and parent_tag == 'Document':
+                document.name = (element.text or '').strip()
+
+        # Only the elements below a placemark are needed after the start
+        # event, so everything else can be discarded once it is complete.
+        if parent_tag in ('kml', 'Document', 'Folder'):
+            element.clear()
+            parent.remove(element)
+
+
+def _haversine(lon1: float, lat1: float, lon2: float, lat2: float) -> float:
+    """Return the great-circle distance in metres between two points
+    given in degrees."""
+    phi1 = radians(lat1)
+    phi2 = radians(lat2)
+    a = (sin((phi2 - phi1) / 2) ** 2 +
+         cos(phi1) * cos(phi2) * sin(radians(lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS * asin(min(1.0, sqrt(a)))
+
+
+def _andoyer(lon1: float, lat1: float, lon2: float, lat2: float) -> float:
+    """Return the distance in metres between two points on the WGS 84
+    ellipsoid using Andoyer's formula (accurate to about 50 ppm of the
+    flattening, i.e. a few metres per thousand kilometres)."""
+    f = (radians(lat1) + radians(lat2)) / 2
+    g = (radians(lat1) - radians(lat2)) / 2
+    lam = radians(lon1 - lon2) / 2
+    s = sin(g) ** 2 * cos(lam) ** 2 + cos(f) ** 2 * sin(lam) ** 2
+    c = cos(g) ** 2 * cos(lam) ** 2 + sin(f) ** 2 * sin(lam) ** 2
+    if s == 0 or c == 0:
+        # Coincident or antipodal points.
+        return _haversine(lon1, lat1, lon2, lat2)
+    omega = atan(sqrt(s / c))
+    r = sqrt(s * c) / omega
+    h1 = (3 * r - 1) / (2 * c)
+    h2 = (3 * r + 1) / (2 * s)
+    return 2 * omega * WGS84_A * (
+        1 + WGS84_F * h1 * sin(f) ** 2 * cos(g) ** 2 -
+        WGS84_F * h2 * cos(f) ** 2 * sin(g) ** 2)
+
+
+def _haversine_np(lon1, lat1, lon2, lat2):
+    """NumPy version of _haversine() working on arrays of degrees."""
+    phi1 = np.radians(lat1)
+    phi2 = np.radians(lat2)
+    a = (np.sin((phi2 - phi1) / 2) ** 2 +
+         np.cos(phi1) * np.cos(phi2) *
+         np.sin(np.radians(lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS * np.arcsin(np.minimum(1.0, np.sqrt(a)))
+
+
+def _andoyer_np(lon1, lat1, lon2, lat2):
+    """NumPy version of _andoyer() working on arrays of degrees."""
+    f = (np.radians(lat1) + np.radians(lat2)) / 2
+    g = (np.radians(lat1) - np.radians(lat2)) / 2
+    lam = np.radians(lon1 - lon2) / 2
+    s = np.sin(g) ** 2 * np.cos(lam) ** 2 + np.cos(f) ** 2 * np.sin(lam) ** 2
+    c = np.cos(g) ** 2 * np.cos(lam) ** 2 + np.sin(f) ** 2 * np.sin(lam) ** 2
+    degenerate = (s == 0) | (c == 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        omega = np.arctan(np.sqrt(s / c))
+        r = np.sqrt(s * c) / omega
+        h1 = (3 * r - 1) / (2 * c)
+        h2 = (3 * r + 1) / (2 * s)
+        distance = 2 * omega * WGS84_A * (
+            1 + WGS84_F * h1 * np.sin(f) ** 2 * np.cos(g) ** 2 -
+            WGS84_F * h2 * np.cos(f) ** 2 * np.sin(g) ** 2)
+    if degenerate.any():
+        distance[degenerate] = _haversine_np(lon1, lat1, lon2, lat2)[
+            degenerate]
+    return distance
+
+
+# The distance functions supported by the metrics methods. The first
+# function of each pair is used without NumPy, the second with NumPy.
+_DISTANCE_METHODS = {
+    'haversine': (_haversine, _haversine_np),
+    'ellipsoidal': (_andoyer, _andoyer_np),
+}
+
+
+def _distance_functions(method: str) -> tuple:
+    """Return the scalar and NumPy distance function for a method."""
+    try:
+        return _DISTANCE_METHODS[method]
+    except KeyError:
+        raise ValueError(f'Unknown distance method "{method}" - supported ' +
+                         f'methods: {list(_DISTANCE_METHODS)}') from None
+
+
+def _as_numpy(buffer) -> 'np.ndarray':
+    """Return an (n, 3) NumPy view of a packed coordinate buffer."""
+    return np.frombuffer(buffer, dtype=np.float64).reshape(-1, 3)
+
+
+def _segment_distances(buffer, method: str):
+    """Return the distances in metres between consecutive coordinates
+    in a packed coordinate buffer. The result is a NumPy array when NumPy
+    is installed, otherwise a list."""
+    distance, distance_np = _distance_functions(method)
+    if np is not None:
+        if len(buffer) < 6:
+            return np.zeros(0)
+        xyz = _as_numpy(buffer)
+        return distance_np(xyz[:-1, 0], xyz[:-1, 1], xyz[1:, 0], xyz[1:, 1])
+
+    lons = buffer[0::3]
+    lats = buffer[1::3]
+    return list(map(distance, lons[:-1], lats[:-1], lons[1:], lats[1:]))
+
+
+def _bbox(buffer) -> (tuple or None):
+    """Return the bounding box of a packed coordinate buffer as a
+    (min_longitude, min_latitude, max_longitude, max_latitude) tuple or
+    None if the buffer is empty."""
+    if len(buffer) == 0:
+        return None
+    if np is not None:
+        xyz = _as_numpy(buffer)
+        minimum = xyz[:, 0:2].min(axis=0)
+        maximum = xyz[:, 0:2].max(axis=0)
+        return (float(minimum[0]), float(minimum[1]),
+                float(maximum[0]), float(maximum[1]))
+
+    lons = buffer[0::3]
+    lats = buffer[1::3]
+    return min(lons), min(lats), max(lons), max(lats)
+
+
+def _merge_bboxes(bboxes) -> (tuple or None):
+    """Return the bounding box enclosing all the given bounding boxes.
+    None values are ignored."""
+    bboxes = [bbox for bbox in bboxes if bbox is not None]
+    if len(bboxes) == 0:
+        return None
+    return (min(bbox[0] for bbox in bboxes), min(bbox[1] for bbox in bboxes),
+            max(bbox[2] for bbox in bboxes), max(bbox[3] for bbox in bboxes))
+
+
+def _nearest_vertex(buffer, longitude: float, latitude: float,
+                    method: str = 'haversine') -> (tuple or None):
+    """Return a (index, distance) tuple for the coordinate in a packed
+    coordinate buffer that is closest to the given position."""
+    if len(buffer) == 0:
+        return None
+    distance, distance_np = _distance_functions(method)
+    if np is not None:
+        xyz = _as_numpy(buffer)
+        distances = distance_np(xyz[:, 0], xyz[:, 1], longitude, latitude)
+        index = int(distances.argmin())
+        return index, float(distances[index])
+
+    lons = buffer[0::3]
+    lats = buffer[1::3]
+    distances = [distance(lon, lat, longitude, latitude)
+                 for lon, lat in zip(lons, lats)]
+    index = min(range(len(distances)), key=distances.__getitem__)
+    return index, distances[index]
+
+
+def _parse_kml_object(tree: ElementTree.Element):
+    """Create the KML object for an element. Returns None for elements
+    that are not supported."""
+    if _local_name(tree.tag) == 'Document':
         o = KmlDocument()
+    else:
+        return None
     o.parse(tree)
 
     return o
 
 
+def _tree_placemarks(element: ElementTree.Element, folders: tuple = ()):
+    """Yield a (folders, geometry) tuple for each placemark below the
+    element in a parsed tree. See also _iter_placemarks()."""
+    for child in element:
+        tag = _local_name(child.tag)
+        if tag == 'Placemark':
+            geometry = _parse_placemark(child)
+            if geometry is not None:
+                yield folders, geometry
+        elif tag == 'Folder':
+            name = _child_text(child, 'name')
+            yield from _tree_placemarks(
+                child, folders + (name if name is not None else '',))
+        elif tag == 'Document':
+            yield from _tree_placemarks(child, folders)
+
+
+def _format_coordinates(buffer, chunk_size: int = 4096,
+                        fmt: str = '%r,%r,%r', separator: str = ' '):
+    """Yield the text for a packed coordinate buffer in chunks of
+    chunk_size coordinates. The default is the KML coordinates format.
+    The values use the shortest representation that converts back to
+    the same double."""
+    for start in range(0, len(buffer), 3 * chunk_size):
+        values = tuple(buffer[start:start + 3 * chunk_size])
+        text = separator.join([fmt] * (len(values) // 3)) % values
+        yield text if start == 0 else separator + text
+
+
+def write_geojson(geojson_fd, geometries):
+    """Stream the geometries as a GeoJSON FeatureCollection to a text
+    file object. The items are either geometries or (folders, geometry)
+    tuples as yielded by iter_placemarks(). Each feature is written as
+    soon as it is read from geometries.
+
+    The name, description, styleUrl, and folders (if known) are added to
+    the properties of the feature together with the properties of the
+    geometry. Properties that are not JSON serializable are converted to
+    strings."""
+    geojson_fd.write('{"type": "FeatureCollection", "features": [')
+    first = True
+    for item in geometries:
+        if isinstance(item, tuple):
+            folders, geometry = item
+        else:
+            folders, geometry = None, item
+        properties = {'name': geometry.name,
+                      'description': geometry.description,
+                      'styleUrl': geometry.style_url}
+        if folders is not None:
+            properties['folders'] = folders
+        properties.update(geometry.properties)
+
+        geojson_fd.write('\n' if first else ',\n')
+        first = False
+        geojson_fd.write('{"type": "Feature", "geometry": {"type": ')
+        geojson_fd.write(f'"{geometry.type}", "coordinates": ')
+        _write_geojson_coordinates(geojson_fd, geometry)
+        geojson_fd.write('}, "properties": ')
+        geojson_fd.write(json.dumps(properties, default=str))
+        geojson_fd.write('}')
+    geojson_fd.write('\n]}\n')
+
+
+def _write_geojson_coordinates(geojson_fd, geometry):
+    """Write the GeoJSON coordinates member of a geometry."""
+    if geometry.type == 'Point':
+        geojson_fd.write('[%r, %r, %r]' % tuple(geometry._vertices()))
+        return
+
+    rings = geometry._buffers()
+    if geometry.type == 'Polygon':
+        geojson_fd.write('[')
+    for i, ring in enumerate(rings):
+        geojson_fd.write('[' if i == 0 else ', [')
+        for text in _format_coordinates(ring, fmt='[%r,%r,%r]',
+                                        separator=','):
+            geojson_fd.write(text)
+        geojson_fd.write(']')
+    if geometry.type == 'Polygon':
+        geojson_fd.write(']')
+
+
+class KmlWriter(object):
+    """Streaming writer for KML documents. The placemarks are written as
+    they are added, so the memory usage does not depend on the number
+    of geometries. Use it as a context manager:
+
+    with open('tracks.kml', 'wb') as kml_fd:
+        with KmlWriter(kml_fd, name='Tracks') as writer:
+            for geometry in geometries:
+                writer.write(geometry)
+    """
+    _generator: (XMLGenerator or None) = None
+    _name: (str or None) = None
+    _folders: tuple = ()
+
+    def __init__(self, kml_fd, name: (str or None) = None):
+        """kml_fd is a binary file object the document is written to."""
+        self._generator = XMLGenerator(kml_fd, encoding='utf-8',
+                                       short_empty_elements=True)
+        self._name = name
+        self._folders = ()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.end()
+
+    def _element(self, tag: str, text: (str or None)):
+        """Write a simple element with text (if text is not None)."""
+        if text is not None:
+            self._generator.startElement(tag, {})
+            self._generator.characters(text)
+            self._generator.endElement(tag)
+
+    def start(self):
+        """Write the start of the KML document."""
+        self._generator.startDocument()
+        self._generator.startElement('kml', {'xmlns': NS_KML[1:-1]})
+        self._generator.startElement('Document', {})
+        self._element('name', self._name)
+        self._generator.ignorableWhitespace('\n')
+
+    def end(self):
+        """Close any open folders and write the end of the document."""
+        self._set_folders(())
+        self._generator.endElement('Document')
+        self._generator.endElement('kml')
+        self._generator.ignorableWhitespace('\n')
+        self._generator.endDocument()
+
+    def _set_folders(self, folders: tuple):
+        """Close and open Folder elements to get to the folders path."""
+        common = 0
+        while (common < min(len(folders), len(self._folders)) and
+               folders[common] == self._folders[common]):
+            common += 1
+        for _ in range(len(self._folders) - common):
+            self._generator.endElement('Folder')
+            self._generator.ignorableWhitespace('\n')
+        for name in folders[common:]:
+            self._generator.startElement('Folder', {})
+            self._element('name', name)
+            self._generator.ignorableWhitespace('\n')
+        self._folders = tuple(folders)
+
+    def _coordinates(self, buffer):
+        self._generator.startElement('coordinates', {})
+        for text in _format_coordinates(buffer):
+            self._generator.characters(text)
+        self._generator.endElement('coordinates')
+
+    def write(self, geometry, folders: tuple = ()):
+        """Write a geometry as a placemark. The folders argument is the
+        path of folder names to place it in (as yielded by
+        iter_placemarks()). Consecutive placemarks in the same folder
+        share the Folder element."""
+        self._set_folders(folders)
+        self._generator.startElement('Placemark', {})
+        self._element('name', geometry.name)
+        self._element('description', geometry.description)
+        self._element('styleUrl', geometry.style_url)
+        self._generator.startElement(geometry.type, {})
+        if geometry.type == 'Polygon':
+            rings = geometry._buffers()
+            for i, ring in enumerate(rings):
+                boundary = 'outerBoundaryIs' if i == 0 else 'innerBoundaryIs'
+                self._generator.startElement(boundary, {})
+                self._generator.startElement('LinearRing', {})
+                self._coordinates(ring)
+                self._generator.endElement('LinearRing')
+                self._generator.endElement(boundary)
+        else:
+            self._coordinates(geometry._vertices())
+        self._generator.endElement(geometry.type)
+        self._generator.endElement('Placemark')
+        self._generator.ignorableWhitespace('\n')
+
+    def write_all(self, geometries):
+        """Write all geometries from an iterable. The items are either
+        geometries or (folders, geometry) tuples."""
+        for item in geometries:
+            if isinstance(item, tuple):
+                self.write(item[1], item[0])
+            else:
+                self.write(item)
+
+
+def write_kml(file: (Path or str), geometries, name: (str or None) = None):
+    """Stream the geometries (see KmlWriter.write_all()) to a KML file."""
+    with Path(file).open(mode='wb') as kml_fd:
+        with KmlWriter(kml_fd, name) as writer:
+            writer.write_all(geometries)
+
+
+def write_kmz(file: (Path or str), geometries, name: (str or None) = None,
+              kml_file: str = 'doc.kml', compresslevel: int = 6):
+    """Stream the geometries (see KmlWriter.write_all()) to a deflated
+    KML file inside a new KMZ archive."""
+    with ZipFile(file, mode='w', compression=ZIP_DEFLATED,
+                 compresslevel=compresslevel) as kmz_fd:
+        with kmz_fd.open(kml_file, mode='w', force_zip64=True) as kml_fd:
+            with KmlWriter(kml_fd, name) as writer:
+                writer.write_all(geometries)
+
+
+def _cache_path(file: Path, cache: (bool or Path or str)) -> (Path or None):
+    """Return the path of the cache file for a KML or KMZ file or None if
+    caching is disabled. If cache is a directory, the cache file name
+    includes a hash of the full path to avoid collisions."""
+    if cache is False or cache is None:
+        return None
+    if cache is True:
+        return file.with_name(f'{file.name}{CACHE_SUFFIX}')
+    path_hash = blake2b(str(file.resolve()).encode('utf-8'),
+                        digest_size=8).hexdigest()
+    return Path(cache) / f'{file.name}-{path_hash}{CACHE_SUFFIX}'
+
+
+def _file_digest(file: Path) -> bytes:
+    """Return the BLAKE2b digest of the content of a file."""
+    digest = blake2b(digest_size=32)
+    with file.open(mode='rb') as fd:
+        for block in iter(lambda: fd.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.digest()
+
+
+def _document_metadata(document: ('KmlDocument' or None)) -> dict:
+    """Return the name and styles of a document for the cache."""
+    if document is None:
+        return {'name': None, 'styles': {}, 'style_maps': {}}
+    return {
+        'name': document.name,
+        'styles': {style_id: style.properties
+                   for style_id, style in document.styles.items()},
+        'style_maps': {
+            style_id: {key: [url, style.properties if style else None]
+                       for key, (url, style) in style_map.pairs.items()}
+            for style_id, style_map in document.style_maps.items()},
+    }
+
+
+def _document_from_metadata(metadata: dict) -> 'KmlDocument':
+    """Recreate a document from the output of _document_metadata()."""
+    document = KmlDocument()
+    document.name = metadata['name']
+    for style_id, properties in metadata['styles'].items():
+        style = KmlStyle()
+        style.id = style_id
+        style.properties = properties
+        document.add_style(style)
+    for style_id, pairs in metadata['style_maps'].items():
+        style_map = KmlStyleMap()
+        style_map.id = style_id
+        for key, (url, properties) in pairs.items():
+            style = None
+            if properties is not None:
+                style = KmlStyle()
+                style.properties = properties
+            style_map.pairs[key] = (url, style)
+        document.add_style(style_map)
+    return document
+
+
+def _write_cache(cache_file: Path, file: Path,
+                 geometries: 'GeometryCollection',
+                 document: ('KmlDocument' or None), kml_file: str = None):
+    """Write the geometries and document loaded from file to a cache
+    file. The cache starts with the fingerprint of the source file and
+    the metadata as JSON followed by all the coordinates as one block
+    of doubles."""
+    stat = file.stat()
+    metadata = {
+        'byteorder': sys.byteorder,
+        'kml_file': kml_file,
+        'document': _document_metadata(document),
+        'geometries': [[geometry.type, geometry.name, geometry.description,
+                        geometry.style_url, geometry.properties,
+                        [len(buffer) // 3 for buffer in geometry._buffers()]]
+                       for geometry in geometries],
+    }
+    try:
+        metadata_json = json.dumps(metadata).encode('utf-8')
+    except TypeError:
+        # The properties can't be stored in the cache.
+        return
+    padding = -(_CACHE_HEADER.size + len(metadata_json)) % 8
+    # A concurrent load never sees a partial cache. Failing to write the
+    # cache is not an error.
+    try:
+        with atomic_write(cache_file) as cache_fd:
+            cache_fd.write(_CACHE_HEADER.pack(
+                _CACHE_MAGIC, stat.st_size, stat.st_mtime_ns,
+                _file_digest(file), len(metadata_json)))
+            cache_fd.write(metadata_json)
+            cache_fd.write(bytes(padding))
+            for geometry in geometries:
+                for buffer in geometry._buffers():
+                    cache_fd.write(buffer)
+    except OSError:
+        pass
+
+
+def _read_cache(cache_file: Path, file: Path) -> (tuple or None):
+    """Return a (geometries, kml_file, document) tuple from a cache file
+    or None if the cache does not exist or is stale. The coordinates of
+    the line strings are memory mapped from the cache file."""
+    try:
+        with cache_file.open(mode='rb') as cache_fd:
+            header = cache_fd.read(_CACHE_HEADER.size)
+            if len(header) != _CACHE_HEADER.size:
+                return None
+            (magic, size, mtime_ns, digest,
+             metadata_length) = _CACHE_HEADER.unpack(header)
+            stat = file.stat()
+            if magic != _CACHE_MAGIC or size != stat.st_size:
+                return None
+            if mtime_ns != stat.st_mtime_ns and digest != _file_digest(file):
+                return None
+            metadata = json.loads(cache_fd.read(metadata_length))
+            if metadata['byteorder'] != sys.byteorder:
+                return None
+            mapped = mmap(cache_fd.fileno(), 0, access=ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+
+    offset = _CACHE_HEADER.size + metadata_length
+    offset += -offset % 8
+    coordinates = memoryview(mapped)[offset:].cast('d')
+    geometries = GeometryCollection()
+    position = 0
+    for (geometry_type, name, description, style_url, properties,
+         counts) in metadata['geometries']:
+        buffers = []
+        for count in counts:
+            buffers.append(coordinates[position:position + 3 * count])
+            position += 3 * count
+        geometry = _geometry_from_buffers(geometry_type, buffers)
+        geometry.name = name
+        geometry.description = description
+        geometry.style_url = style_url
+        geometry.properties = properties
+        geometries.add(geometry)
+    return (geometries, metadata['kml_file'],
+            _document_from_metadata(metadata['document']))
+
+
 class Kml(object):
     """Class for working with KML file. See:
         https://developers.google.com/kml/documentation and
         https://developers.google.com/kml/documentation/kmlreference"""
     _file: (Path or None) = None
     _objects: list = []
+    _geometries: 'GeometryCollection' = None
 
     def __init__(self):
         self._file = None
         self._objects = []
+        self._geometries = GeometryCollection()
 
     @property
     def file(self) -> (Path or None):
@@ -39,48 +753,75 @@ class Kml(object):
         """Set the path to the KMZ file."""
         self._file = Path(file)
 
-    def load(self, file: (Path or str)):
-        """Load the XML from a KML file."""
+    @property
+    def geometries(self) -> 'GeometryCollection':
+        """Return the collection with the geometries of the placemarks."""
+        return self._geometries
+
+    @property
+    def document(self) -> ('KmlDocument' or None):
+        """Return the first KML Document (with the shared styles) or None
+        if no document has been loaded."""
+        for kml_object in self._objects:
+            if isinstance(kml_object, KmlDocument):
+                return kml_object
+        return None
+
+    def load(self, file: (Path or str), cache: (bool or Path or str) = False):
+        """Load the XML from a KML file.
+
+        If cache is True, the parsed geometries are stored in a binary
+        cache file next to the KML file; cache can also be the directory
+        to store the cache file in. A later load reuses the cache as long
+        as the KML file has not changed. See also Kmz.load()."""
         self.file = file
+        cache_file = _cache_path(self.file, cache)
+        if cache_file is not None:
+            cached = _read_cache(cache_file, self.file)
+            if cached is not None:
+                self._geometries = cached[0]
+                self._objects.append(cached[2])
+                return
+
         with self.file.open(mode='r', encoding='utf-8') as kml_fd:
             tree = ElementTree.parse(kml_fd)
 
         self.parse(tree)
+        if cache_file is not None:
+            _write_cache(cache_file, self.file, self._geometries,
+                         self.document)
+
+    def save(self, file: (Path or str), name: (str or None) = None):
+        """Write the geometries to a KML file."""
+        self.file = file
+        write_kml(self.file, self._geometries, name)
+
+    def iter_placemarks(self, file: (Path or str)):
+        """Stream the placemarks from a KML file without loading the
+        whole document into memory. Yields a (folders, geometry) tuple
+        for each placemark with a LineString or Point geometry where
+        folders is a tuple with the names of the enclosing folders."""
+        self.file = file
+        with self.file.open(mode='rb') as kml_fd:
+            yield from self._stream(kml_fd)
+
+    def _stream(self, kml_fd):
+        """Stream the placemarks from an open KML file while collecting
+        the shared styles in a new document."""
+        document = KmlDocument()
+        self._objects.append(document)
+        yield from _iter_placemarks(kml_fd, document)
 
     def parse(self, tree: ElementTree.ElementTree):
         """Parse the XML from a KML file."""
         kml = tree.getroot()
         for child in list(kml):
-            self._objects.append(_parse_kml_object(child))
-
-    #     top_folder = tree.getroot().find(f'./{NS_KML}Document/{NS_KML}Folder')
-    #     self._parse_folder(top_folder)
-    #     folders = top_folder.findall(f'./{NS_KML}Folder')
-    #     for folder in folders:
-    #         self._parse_folder(folder)
-    #
-    # def _parse_folder(self,
-    #                   folder: ElementTree.Element, parent_name: str = ""):
-    #     folder_name = _kml_text(folder, 'name')
-    #     if len(parent_name) > 0:
-    #         name = f'{parent_name}: {folder_name}'
-    #     else:
-    #         name = folder_name
-    #
-    #     place_marks = folder.findall(f'./{NS_KML}Placemark')
-    #     for place_mark in place_marks:
-    #         place_mark_name = _kml_text(place_mark, 'name')
-    #         description = _kml_text(place_mark, 'description')
-    #         xpath_coordinates = f'./{NS_KML}LineString/{NS_KML}coordinates'
-    #         coordinates = place_mark.find(xpath_coordinates)
-    #         line_string = LineString()
-    #         line_string.add_coordinates_from_text(coordinates.text)
-    #         line_string.name = f'{name}::{place_mark_name}'
-    #         line_string.description = description
-    #         self._objects.append(line_string)
-    #
-    #     for child_folder in folder.findall(f'./{NS_KML}Folder'):
-    #         self._parse_folder(child_folder, name)
+            kml_object = _parse_kml_object(child)
+            if kml_object is not None:
+                self._objects.append(kml_object)
+
+        for folders, geometry in _tree_placemarks(kml):
+            self._geometries.add(geometry)
 
 
 class KmlObject(object):
@@ -99,23 +840,130 @@ class KmlObject(object):
 
 
 class KmlDocument(KmlObject):
+    """A KML Document with its shared styles. Styles are referenced by
+    placemarks through their styleUrl which may point to a Style or to a
+    StyleMap selecting a style for the normal and highlight states.
+    resolve_style() follows these references once per URL and key and
+    remembers the resulting properties."""
     _styles: dict = {}
     _style_maps: dict = {}
+    _resolved: dict = {}  # (style_url, key) -> flattened properties
 
     def __init__(self):
-        _styles = {}
-        _style_maps = {}
+        self._styles = {}
+        self._style_maps = {}
+        self._resolved = {}
         super().__init__()
 
+    @property
+    def styles(self) -> dict:
+        """Return the Style objects by id."""
+        return self._styles
+
+    @property
+    def style_maps(self) -> dict:
+        """Return the StyleMap objects by id."""
+        return self._style_maps
+
+    def add_style(self, style):
+        """Add a KmlStyle or KmlStyleMap to the document."""
+        if isinstance(style, KmlStyleMap):
+            self._style_maps[style.id] = style
+        else:
+            self._styles[style.id] = style
+        self._resolved = {}
+
     def parse(self, tree: ElementTree.Element):
         for child in list(tree):
-            if child.tag == 'name':
-                self._name = child.text.strip()
-            elif child.tag == 'Style':
+            tag = _local_name(child.tag)
+            if tag == 'name':
+                self._name = (child.text or '').strip()
+            elif tag == 'Style':
                 style = KmlStyle()
                 style.parse(child)
-                self._styles[style.id] = style
-        self.name = _kml_text(tree, 'name')
+                self.add_style(style)
+            elif tag == 'StyleMap':
+                style_map = KmlStyleMap()
+                style_map.parse(child)
+                self.add_style(style_map)
+
+    def resolve_style(self, style_url: (str or None),
+                      key: str = 'normal') -> dict:
+        """Return the flattened style properties for a styleUrl, for
+        example {'LineStyle': {'color': 'ff0000ff', 'width': '4'}}. Style
+        maps are followed using the pair with the given key. Only
+        references to styles in this document are supported; unknown
+        references resolve to an empty dictionary.
+
+        The result is cached and shared between lookups, so it must not
+        be modified."""
+        try:
+            return self._resolved[(style_url, key)]
+        except KeyError:
+            pass
+        properties = self._resolve(style_url, key, set())
+        self._resolved[(style_url, key)] = properties
+        return properties
+
+    def _resolve(self, style_url: (str or None), key: str,
+                 seen: set) -> dict:
+        if style_url is None:
+            return {}
+        style_id = style_url.rpartition('#')[2]
+        if style_id in seen:
+            # Circular reference
+            return {}
+        seen.add(style_id)
+        if style_id in self._styles:
+            return self._styles[style_id].properties
+        style_map = self._style_maps.get(style_id)
+        if style_map is None or key not in style_map.pairs:
+            return {}
+        pair_url, pair_style = style_map.pairs[key]
+        properties = self._resolve(pair_url, key, seen)
+        if pair_style is not None:
+            properties = _merge_style_properties(properties,
+                                                 pair_style.properties)
+        return properties
+
+    def style_table(self, key: str = 'normal') -> dict:
+        """Return the resolved properties of all styles and style maps
+        keyed by their styleUrl (#id)."""
+        return {f'#{style_id}': self.resolve_style(f'#{style_id}', key)
+                for style_id in list(self._styles) + list(self._style_maps)}
+
+    def style_for(self, geometry, key: str = 'normal') -> dict:
+        """Return the resolved style properties of a geometry based on its
+        styleUrl."""
+        return self.resolve_style(geometry.style_url, key)
+
+
+def _element_properties(element: ElementTree.Element):
+    """Convert an element to a dictionary with the local names of the
+    children as keys. Children without children of their own are
+    stored as their text, or their attributes if they have no text."""
+    properties = {}
+    for child in element:
+        if len(child) > 0:
+            value = _element_properties(child)
+        elif child.text is not None and child.text.strip() != '':
+            value = child.text.strip()
+        else:
+            value = dict(child.attrib)
+        properties[_local_name(child.tag)] = value
+    return properties
+
+
+def _merge_style_properties(base: dict, override: dict) -> dict:
+    """Return a new dictionary with the properties of override merged
+    into base one sub style (e.g. LineStyle) at a time."""
+    merged = dict(base)
+    for name, value in override.items():
+        if isinstance(value, dict) and isinstance(merged.get(name), dict):
+            merged[name] = {**merged[name], **value}
+        else:
+            merged[name] = value
+    return merged
 
 
 class KmlStyle(object):
@@ -134,12 +982,62 @@ class KmlStyle(object):
     def id(self, id_value: str):
         self._id = id_value
 
+    @property
+    def properties(self) -> dict:
+        """Return the sub styles (e.g. LineStyle) and their properties."""
+        return self._properties
+
+    @properties.setter
+    def properties(self, properties: dict):
+        self._properties = properties
+
+    def parse(self, tree: ElementTree.Element):
+        self.id = tree.get('id')
+        self._properties = _element_properties(tree)
+
+
+class KmlStyleMap(object):
+    _id: (str or None) = None
+    _pairs: dict = {}  # key -> (styleUrl, inline KmlStyle)
+
+    def __init__(self):
+        self._id = None
+        self._pairs = {}
+
+    @property
+    def id(self):
+        return self._id
+
+    @id.setter
+    def id(self, id_value: str):
+        self._id = id_value
+
+    @property
+    def pairs(self) -> dict:
+        """Return the (styleUrl, KmlStyle) tuple for each key (normal or
+        highlight). Either of the values may be None."""
+        return self._pairs
+
     def parse(self, tree: ElementTree.Element):
         self.id = tree.get('id')
-        for child in list(tree):
-            properties = {}
+        for pair in tree:
+            if _local_name(pair.tag) != 'Pair':
+                continue
+            style = None
+            inline = _child(pair, 'Style')
+            if inline is not None:
+                style = KmlStyle()
+                style.parse(inline)
+            self._pairs[_child_text(pair, 'key')] = (
+                _child_text(pair, 'styleUrl'), style)
+
 
-            self._properties[child.tag] = properties
+def _kml_member(kmz_fd: ZipFile) -> str:
+    """Return the name of the KML file inside a KMZ archive."""
+    # A KMZ file is a ZIP file containing a single .KMZ file in the top
+    # level directory (the first encountered will be used - if there are
+    # any more files, they will be ignored.
+    return [f for f in kmz_fd.namelist() if f[-4:].lower() == '.kml'][0]
 
 
 class Kmz(object):
@@ -174,33 +1072,795 @@ class Kmz(object):
         KMZ archive."""
         self._kml = kml
 
-    def load(self, file: (Path or str)):
-        """Load the KMZ file and parse its contents."""
+    def load(self, file: (Path or str), cache: (bool or Path or str) = False):
+        """Load the KMZ file and parse its contents. The cache argument
+        works as for Kml.load() with the cache based on the KMZ file."""
         self.file = file
-        # A KMZ file is a ZIP file containing a single .KMZ file in the top
-        # level directory (the first encountered will be used - if there are
-        # any more files, they will be ignored.
+        cache_file = _cache_path(self.file, cache)
+        if cache_file is not None:
+            cached = _read_cache(cache_file, self.file)
+            if cached is not None:
+                self.kml = Kml()
+                self.kml.file = cached[1]
+                self.kml._geometries = cached[0]
+                self.kml._objects.append(cached[2])
+                return
+
         with ZipFile(file) as kmz_fd:
-            kml_file = [f for f in kmz_fd.namelist()
-                        if f[-4:].lower() == '.kml'][0]
+            kml_file = _kml_member(kmz_fd)
             with kmz_fd.open(kml_file, mode='r') as kml_fd:
                 tree = ElementTree.parse(kml_fd)
 
         self.kml = Kml()
         self.kml.file = kml_file
         self.kml.parse(tree)
+        if cache_file is not None:
+            _write_cache(cache_file, self.file, self.kml.geometries,
+                         self.kml.document, kml_file)
+
+    def save(self, file: (Path or str), name: (str or None) = None):
+        """Write the geometries of the KML object to a KMZ file."""
+        self.file = file
+        kml_file = 'doc.kml'
+        if self.kml.file is not None:
+            kml_file = self.kml.file.name
+        write_kmz(self.file, self.kml.geometries, name, kml_file)
+
+    def iter_placemarks(self, file: (Path or str)):
+        """Stream the placemarks from the KML file inside the KMZ archive
+        without extracting or loading the whole document. Yields the
+        same (folders, geometry) tuples as Kml.iter_placemarks()."""
+        self.file = file
+        with ZipFile(file) as kmz_fd:
+            kml_file = _kml_member(kmz_fd)
+            self.kml = Kml()
+            self.kml.file = kml_file
+            with kmz_fd.open(kml_file, mode='r') as kml_fd:
+                yield from self.kml._stream(kml_fd)
+
+
+def _segments_intersect_bbox(buffer, bbox: tuple) -> bool:
+    """Return whether any vertex or segment of a packed coordinate buffer
+    lies within the bounding box. Segments are clipped against the box
+    with the Liang-Barsky algorithm."""
+    min_lon, min_lat, max_lon, max_lat = bbox
+    if np is not None:
+        xyz = _as_numpy(buffer)
+        x0 = xyz[:, 0]
+        y0 = xyz[:, 1]
+        inside = ((x0 >= min_lon) & (x0 <= max_lon) &
+                  (y0 >= min_lat) & (y0 <= max_lat))
+        if inside.any():
+            return True
+        if len(xyz) < 2:
+            return False
+        dx = x0[1:] - x0[:-1]
+        dy = y0[1:] - y0[:-1]
+        x0 = x0[:-1]
+        y0 = y0[:-1]
+        lower = np.zeros(len(dx))
+        upper = np.ones(len(dx))
+        possible = np.ones(len(dx), dtype=bool)
+        for p, q in ((-dx, x0 - min_lon), (dx, max_lon - x0),
+                     (-dy, y0 - min_lat), (dy, max_lat - y0)):
+            possible &= (p != 0) | (q >= 0)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                t = q / p
+            lower = np.where(p < 0, np.maximum(lower, t), lower)
+            upper = np.where(p > 0, np.minimum(upper, t), upper)
+        return bool((possible & (lower <= upper)).any())
+
+    lons = buffer[0::3]
+    lats = buffer[1::3]
+    for lon, lat in zip(lons, lats):
+        if min_lon <= lon <= max_lon and min_lat <= lat <= max_lat:
+            return True
+    for i in range(len(lons) - 1):
+        x0 = lons[i]
+        y0 = lats[i]
+        dx = lons[i + 1] - x0
+        dy = lats[i + 1] - y0
+        lower = 0.0
+        upper = 1.0
+        for p, q in ((-dx, x0 - min_lon), (dx, max_lon - x0),
+                     (-dy, y0 - min_lat), (dy, max_lat - y0)):
+            if p == 0:
+                if q < 0:
+                    break
+            elif p < 0:
+                lower = max(lower, q / p)
+            else:
+                upper = min(upper, q / p)
+        else:
+            if lower <= upper:
+                return True
+    return False
+
+
+def _planar(buffer) -> tuple:
+    """Project a packed coordinate buffer onto a local plane (metres)
+    using an equirectangular projection around the mean latitude.
+    Returns the x and y values as NumPy arrays or lists."""
+    if np is not None:
+        xyz = _as_numpy(buffer)
+        scale = radians(1) * EARTH_RADIUS
+        x_scale = scale * cos(radians(float(xyz[:, 1].mean())))
+        return xyz[:, 0] * x_scale, xyz[:, 1] * scale
+
+    lons = buffer[0::3]
+    lats = buffer[1::3]
+    scale = radians(1) * EARTH_RADIUS
+    x_scale = scale * cos(radians(fsum(lats) / len(lats)))
+    return [lon * x_scale for lon in lons], [lat * scale for lat in lats]
+
+
+def _farthest(xs, ys, start: int, end: int) -> tuple:
+    """Return the (index, distance) of the vertex between start and end
+    (exclusive) that is farthest from the segment joining them."""
+    x0 = float(xs[start])
+    y0 = float(ys[start])
+    dx = float(xs[end]) - x0
+    dy = float(ys[end]) - y0
+    length2 = dx * dx + dy * dy
+    if np is not None:
+        px = xs[start + 1:end] - x0
+        py = ys[start + 1:end] - y0
+        if end - start > 32:
+            if length2 > 0:
+                t = np.clip((px * dx + py * dy) / length2, 0.0, 1.0)
+                px = px - t * dx
+                py = py - t * dy
+            distances = np.hypot(px, py)
+            offset = int(distances.argmax())
+            return start + 1 + offset, float(distances[offset])
+        # Short ranges are faster with plain floats.
+        offsets = zip(px.tolist(), py.tolist())
+    else:
+        offsets = ((xs[i] - x0, ys[i] - y0) for i in range(start + 1, end))
+
+    farthest = (start + 1, -1.0)
+    for i, (px, py) in enumerate(offsets, start + 1):
+        if length2 > 0:
+            t = min(1.0, max(0.0, (px * dx + py * dy) / length2))
+            px -= t * dx
+            py -= t * dy
+        distance = sqrt(px * px + py * py)
+        if distance > farthest[1]:
+            farthest = (i, distance)
+    return farthest
+
+
+def _douglas_peucker_weights(xs, ys, tolerance: float) -> list:
+    """Return the Douglas-Peucker weight of each vertex: the largest
+    tolerance (metres) at which the vertex is kept. Ranges where no
+    vertex is farther than tolerance from the segment are not split
+    further and their vertices get the weight 0."""
+    n = len(xs)
+    weights = [0.0] * n
+    weights[0] = weights[-1] = inf
+    stack = [(0, n - 1, inf)]
+    while stack:
+        start, end, limit = stack.pop()
+        if end - start < 2:
+            continue
+        index, distance = _farthest(xs, ys, start, end)
+        if distance <= tolerance:
+            continue
+        # A vertex can't be kept without the vertex that split the range
+        # it belongs to, so the weights decrease down the recursion.
+        weights[index] = min(distance, limit)
+        stack.append((start, index, weights[index]))
+        stack.append((index, end, weights[index]))
+    return weights
+
+
+def _visvalingam_weights(xs, ys, tolerance: float) -> list:
+    """Return the Visvalingam-Whyatt weight of each vertex: the
+    effective area (square metres) of the vertex when it is removed.
+    Once all remaining vertices have an area larger than tolerance the
+    elimination stops and they get the weight infinity."""
+    n = len(xs)
+    weights = [inf] * n
+    if n < 3:
+        return weights
+    if np is not None:
+        # The elimination works on one vertex at a time, which is faster
+        # with plain floats.
+        xs = xs.tolist()
+        ys = ys.tolist()
+
+    def area(a: int, b: int, c: int) -> float:
+        return abs((xs[b] - xs[a]) * (ys[c] - ys[a]) -
+                   (xs[c] - xs[a]) * (ys[b] - ys[a])) / 2
+
+    previous = list(range(-1, n - 1))
+    following = list(range(1, n + 1))
+    areas = [inf] * n
+    for i in range(1, n - 1):
+        areas[i] = area(i - 1, i, i + 1)
+    heap = [(areas[i], i) for i in range(1, n - 1)]
+    heapify(heap)
+    while heap:
+        current, i = heappop(heap)
+        if current != areas[i] or weights[i] != inf:
+            # Stale heap entry
+            continue
+        if current > tolerance:
+            break
+        weights[i] = current
+        before = previous[i]
+        after = following[i]
+        following[before] = after
+        previous[after] = before
+        # The effective area of a neighbour never becomes smaller than
+        # that of the vertex just removed.
+        for j in (before, after):
+            if 0 < j < n - 1:
+                areas[j] = max(current, area(previous[j], j, following[j]))
+                heappush(heap, (areas[j], j))
+    return weights
+
+
+# The simplification methods and whether their weights are computed
+# down to the smallest (True) or up to the largest (False) tolerance.
+_SIMPLIFY_METHODS = {
+    'douglas-peucker': (_douglas_peucker_weights, True),
+    'visvalingam': (_visvalingam_weights, False),
+}
+
+
+def _rings_contain(rings: list, x: float, y: float) -> bool:
+    """Return whether the position is inside the rings (a list of
+    (longitudes, latitudes) tuples) using the even-odd rule."""
+    inside = False
+    for xs, ys in rings:
+        xj = xs[-1]
+        yj = ys[-1]
+        for xi, yi in zip(xs, ys):
+            if (yi > y) != (yj > y) and x < (xj - xi) * (y - yi) / (
+                    yj - yi) + xi:
+                inside = not inside
+            xj = xi
+            yj = yi
+    return inside
+
+
+def _rings_contain_np(buffers: list, xs, ys):
+    """NumPy version of _rings_contain() testing many positions at once.
+    The loop is over the edges with all positions tested per edge."""
+    inside = np.zeros(len(xs), dtype=bool)
+    if len(xs) == 0:
+        return inside
+    for ring in buffers:
+        if len(ring) < 9:
+            continue
+        xyz = _as_numpy(ring)
+        xj, yj = xyz[-1, 0], xyz[-1, 1]
+        for xi, yi in xyz[:, 0:2].tolist():
+            if yi != yj:
+                crosses = (yi > ys) != (yj > ys)
+                crosses &= xs < (xj - xi) * (ys - yi) / (yj - yi) + xi
+                inside ^= crosses
+            xj = xi
+            yj = yi
+    return inside
+
+
+def _grid_cell_size(bboxes: list) -> float:
+    """Choose the cell size in degrees for a grid index so a typical
+    geometry covers a few cells and the cells are not much smaller than
+    needed for the number of geometries."""
+    bboxes = [bbox for bbox in bboxes if bbox is not None]
+    if len(bboxes) == 0:
+        return 1.0
+    spans = sorted(max(bbox[2] - bbox[0], bbox[3] - bbox[1])
+                   for bbox in bboxes)
+    extent = _merge_bboxes(bboxes)
+    size = max(extent[2] - extent[0], extent[3] - extent[1])
+    cell_size = max(spans[len(spans) // 2], size / sqrt(len(bboxes)))
+    return cell_size if cell_size > 0 else 1.0
+
+
+def _radius_bbox(longitude: float, latitude: float, radius: float) -> tuple:
+    """Return a bounding box enclosing all positions within radius
+    metres of the given position."""
+    delta_latitude = degrees(radius / EARTH_RADIUS)
+    edge = abs(latitude) + delta_latitude
+    if edge >= 90:
+        delta_longitude = 180.0
+    else:
+        delta_longitude = min(180.0, delta_latitude / cos(radians(edge)))
+    return (longitude - delta_longitude, latitude - delta_latitude,
+            longitude + delta_longitude, latitude + delta_latitude)
+
+
+class _GridIndex(object):
+    """Uniform grid over longitude/latitude. Each cell holds the
+    positions (in the collection) of the geometries whose bounding box
+    overlaps the cell."""
+    _cell_size: float = 1.0
+    _cells: dict = {}
+    _bboxes: list = []
+    _min_cell: tuple = None  # The range of occupied cells
+    _max_cell: tuple = None
+
+    def __init__(self, cell_size: float):
+        self._cell_size = cell_size
+        self._cells = {}
+        self._bboxes = []
+        self._min_cell = None
+        self._max_cell = None
+
+    @property
+    def cell_size(self) -> float:
+        return self._cell_size
+
+    def _cell(self, longitude: float, latitude: float) -> tuple:
+        return (floor(longitude / self._cell_size),
+                floor(latitude / self._cell_size))
+
+    def insert(self, bbox: (tuple or None)):
+        """Add the next geometry with the given bounding box. Geometries
+        without coordinates (bbox is None) are not added to any cell."""
+        position = len(self._bboxes)
+        self._bboxes.append(bbox)
+        if bbox is None:
+            return
+        min_x, min_y = self._cell(bbox[0], bbox[1])
+        max_x, max_y = self._cell(bbox[2], bbox[3])
+        for x in range(min_x, max_x + 1):
+            for y in range(min_y, max_y + 1):
+                self._cells.setdefault((x, y), []).append(position)
+        if self._min_cell is None:
+            self._min_cell = (min_x, min_y)
+            self._max_cell = (max_x, max_y)
+        else:
+            self._min_cell = (min(self._min_cell[0], min_x),
+                              min(self._min_cell[1], min_y))
+            self._max_cell = (max(self._max_cell[0], max_x),
+                              max(self._max_cell[1], max_y))
+
+    def query(self, bbox: tuple) -> list:
+        """Return the sorted positions of the geometries with a bounding
+        box intersecting the given bounding box."""
+        if self._min_cell is None:
+            return []
+        min_x, min_y = self._cell(bbox[0], bbox[1])
+        max_x, max_y = self._cell(bbox[2], bbox[3])
+        min_x = max(min_x, self._min_cell[0])
+        min_y = max(min_y, self._min_cell[1])
+        max_x = min(max_x, self._max_cell[0])
+        max_y = min(max_y, self._max_cell[1])
+        positions = set()
+        for x in range(min_x, max_x + 1):
+            for y in range(min_y, max_y + 1):
+                positions.update(self._cells.get((x, y), ()))
+        return sorted(
+            position for position in positions
+            if (self._bboxes[position][0] <= bbox[2] and
+                self._bboxes[position][2] >= bbox[0] and
+                self._bboxes[position][1] <= bbox[3] and
+                self._bboxes[position][3] >= bbox[1]))
+
+    def distance(self, longitude: float, latitude: float) -> int:
+        """Return the number of cells between the cell containing the
+        given position and the nearest occupied cell (as a bound)."""
+        if self._min_cell is None:
+            return 0
+        x, y = self._cell(longitude, latitude)
+        return max(0, self._min_cell[0] - x, x - self._max_cell[0],
+                   self._min_cell[1] - y, y - self._max_cell[1])
+
+    def ring(self, longitude: float, latitude: float, radius: int) -> set:
+        """Return the positions in the cells exactly radius cells away
+        from the cell containing the given position. Returns None once
+        the ring lies completely outside the occupied cells."""
+        if self._min_cell is None:
+            return None
+        center_x, center_y = self._cell(longitude, latitude)
+        if (center_x - radius < self._min_cell[0] and
+                center_x + radius > self._max_cell[0] and
+                center_y - radius < self._min_cell[1] and
+                center_y + radius > self._max_cell[1]):
+            return None
+        positions = set()
+        for x in range(center_x - radius, center_x + radius + 1):
+            if x < self._min_cell[0] or x > self._max_cell[0]:
+                continue
+            if x in (center_x - radius, center_x + radius):
+                ys = range(center_y - radius, center_y + radius + 1)
+            else:
+                ys = (center_y - radius, center_y + radius)
+            for y in ys:
+                positions.update(self._cells.get((x, y), ()))
+        return positions
+
+
+def _pack_geometry(geometry) -> tuple:
+    """Return a compact, picklable representation of a geometry. The
+    coordinates are transferred as the raw bytes of the packed buffer."""
+    return (geometry.type, geometry.name, geometry.description,
+            geometry.style_url, geometry.properties,
+            [buffer.tobytes() for buffer in geometry._buffers()])
+
+
+def _geometry_from_buffers(geometry_type: str, buffers: list):
+    """Create a geometry of the given type from the packed coordinate
+    buffers returned by Geometry._buffers(). The buffers are used as
+    they are (not copied)."""
+    if geometry_type == 'Point':
+        return Point(*buffers[0])
+    elif geometry_type == 'Polygon':
+        geometry = Polygon()
+        geometry._outer = buffers[0]
+        geometry._inner = buffers[1:]
+    else:
+        geometry = LineString()
+        geometry._coordinates = buffers[0]
+    return geometry
+
+
+def _unpack_geometry(packed: tuple):
+    """Recreate a geometry from the output of _pack_geometry()."""
+    (geometry_type, name, description, style_url, properties,
+     coordinates) = packed
+    geometry = _geometry_from_buffers(
+        geometry_type, [array('d', buffer) for buffer in coordinates])
+    geometry.name = name
+    geometry.description = description
+    geometry.style_url = style_url
+    geometry.properties = properties
+    return geometry
+
+
+def _load_packed(file: Path) -> tuple:
+    """Load the placemarks of a KML or KMZ file. Returns a tuple with the
+    list of packed geometries and the error message (None on success).
+    This is the worker function for load_files()."""
+    if file.suffix.lower() == '.kmz':
+        reader = Kmz()
+    else:
+        reader = Kml()
+    geometries = []
+    try:
+        for folders, geometry in reader.iter_placemarks(file):
+            geometry.set_property('file', str(file))
+            geometry.set_property('folders', folders)
+            geometries.append(_pack_geometry(geometry))
+    except Exception as err:
+        return [], f'{type(err).__name__}: {err}'
+    return geometries, None
+
+
+def load_files(locations: list, glob: str = '*.km[lz]',
+               workers: (int or None) = None) -> tuple:
+    """Load all the KML and KMZ files found by wistools.io.get_files()
+    for the locations and glob into one GeometryCollection. The files
+    are parsed in a pool of worker processes; workers defaults to the
+    number of CPUs, and with workers=1 the files are parsed in the
+    current process.
+
+    Each geometry gets the file and folders properties with the path of
+    the file and the tuple of folder names it was found in. The
+    geometries are added in the order of the file paths.
+
+    Returns a (collection, errors) tuple where errors is a dictionary
+    with the error message for each file that could not be loaded."""
+    files = sorted(get_files([str(location) for location in locations],
+                             glob))
+    if workers == 1 or len(files) < 2:
+        results = map(_load_packed, files)
+        executor = None
+    else:
+        executor = ProcessPoolExecutor(max_workers=workers)
+        results = executor.map(_load_packed, files)
+
+    collection = GeometryCollection()
+    errors = {}
+    try:
+        for file, (geometries, error) in zip(files, results):
+            if error is not None:
+                errors[file] = error
+            for packed in geometries:
+                collection.add(_unpack_geometry(packed))
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    return collection, errors
 
 
 class GeometryCollection(object):
+    """A collection of geometries. The metrics methods work on all the
+    geometries at once, so with NumPy installed the calculations are
+    done in a single vectorized pass over the coordinates.
+
+    The query methods use a grid based spatial index that is built on
+    the first query and kept up to date when geometries are added. The
+    index is based on the bounding boxes when the geometries are added,
+    so call build_index() after changing the coordinates of a geometry
+    that is already in the collection."""
     _objects: list = []
+    _index: (_GridIndex or None) = None
 
-    def __init__(self):
+    def __init__(self, geometries=None):
         self._objects = []
+        self._index = None
+        if geometries is not None:
+            for geometry in geometries:
+                self.add(geometry)
+
+    @property
+    def geometries(self) -> list:
+        """Return the list of geometries in the collection."""
+        return self._objects
+
+    def add(self, geometry):
+        """Add a geometry to the collection."""
+        self._objects.append(geometry)
+        if self._index is not None:
+            self._index.insert(geometry.bbox())
+
+    def build_index(self, cell_size: (float or None) = None):
+        """(Re)build the spatial index. The cell size is in degrees. If
+        it is not given, it is chosen from the size of the geometries and
+        the extent of the collection."""
+        bboxes = [geometry.bbox() for geometry in self._objects]
+        if cell_size is None:
+            cell_size = _grid_cell_size(bboxes)
+        self._index = _GridIndex(cell_size)
+        for bbox in bboxes:
+            self._index.insert(bbox)
+
+    def _get_index(self) -> _GridIndex:
+        if self._index is None:
+            self.build_index()
+        return self._index
+
+    def query_bbox(self, bbox: tuple) -> list:
+        """Return the geometries that have at least one vertex or segment
+        inside the (min_longitude, min_latitude, max_longitude,
+        max_latitude) bounding box."""
+        return [self._objects[position]
+                for position in self._get_index().query(bbox)
+                if _segments_intersect_bbox(
+                    self._objects[position]._vertices(), bbox)]
+
+    def query_radius(self, longitude: float, latitude: float,
+                     radius: float, method: str = 'haversine') -> list:
+        """Return a list of (geometry, distance) tuples sorted by distance
+        for the geometries with a vertex within radius metres of the
+        given position. The distance is to the nearest vertex."""
+        results = []
+        for position in self._get_index().query(
+                _radius_bbox(longitude, latitude, radius)):
+            geometry = self._objects[position]
+            nearest = geometry.nearest_vertex(longitude, latitude, method)
+            if nearest is not None and nearest[1] <= radius:
+                results.append((geometry, nearest[1]))
+        results.sort(key=lambda result: result[1])
+        return results
+
+    def nearest(self, longitude: float, latitude: float, k: int = 1,
+                method: str = 'haversine') -> list:
+        """Return a list with up to k (geometry, distance) tuples for the
+        geometries closest to the given position sorted by distance. The
+        distance in metres is to the nearest vertex of the geometry."""
+        index = self._get_index()
+        results = []
+        seen = set()
+        radius = index.distance(longitude, latitude)
+        while True:
+            positions = index.ring(longitude, latitude, radius)
+            if positions is None:
+                break
+            for position in positions - seen:
+                seen.add(position)
+                nearest = self._objects[position].nearest_vertex(
+                    longitude, latitude, method)
+                results.append((self._objects[position], nearest[1]))
+            if len(results) >= k:
+                results.sort(key=lambda result: result[1])
+                del results[k:]
+                # Any geometry not seen yet is at least radius cells away.
+                # A degree of longitude shrinks towards the poles, so use
+                # its length at the edge of the searched area.
+                edge = min(90.0, abs(latitude) +
+                           (radius + 1) * index.cell_size)
+                covered = (radius * index.cell_size * cos(radians(edge)) *
+                           radians(1) * EARTH_RADIUS)
+                if results[-1][1] <= covered:
+                    break
+            radius += 1
+
+        results.sort(key=lambda result: result[1])
+        return results[:k]
+
+    def __len__(self) -> int:
+        return len(self._objects)
+
+    def __iter__(self):
+        return iter(self._objects)
+
+    def __getitem__(self, index):
+        return self._objects[index]
+
+    def lengths(self, method: str = 'haversine') -> list:
+        """Return the length in metres of each geometry. Only line
+        strings have a length; other geometries have the length 0.
+        The method is either haversine or ellipsoidal."""
+        distance_np = _distance_functions(method)[1]
+        if np is None:
+            return [geometry.length(method)
+                    if isinstance(geometry, LineString) else 0.0
+                    for geometry in self._objects]
+
+        buffers = [geometry.packed_coordinates
+                   if isinstance(geometry, LineString) else array('d')
+                   for geometry in self._objects]
+        if len(buffers) == 0:
+            return []
+        offsets = np.zeros(len(buffers) + 1, dtype=np.int64)
+        np.cumsum([len(buffer) // 3 for buffer in buffers], out=offsets[1:])
+        if offsets[-1] < 2:
+            return [0.0] * len(buffers)
+
+        xyz = np.concatenate([_as_numpy(buffer) for buffer in buffers])
+        distances = distance_np(xyz[:-1, 0], xyz[:-1, 1],
+                                xyz[1:, 0], xyz[1:, 1])
+        # Remove the "segments" joining two geometries.
+        boundaries = offsets[1:-1]
+        boundaries = boundaries[(boundaries > 0) & (boundaries < offsets[-1])]
+        distances[boundaries - 1] = 0.0
+        cumulative = np.concatenate(([0.0], np.cumsum(distances)))
+        first = np.minimum(offsets[:-1], len(cumulative) - 1)
+        last = np.maximum(offsets[1:] - 1, 0)
+        result = np.where(offsets[1:] > offsets[:-1],
+                          cumulative[last] - cumulative[first], 0.0)
+        return result.tolist()
+
+    def length(self, method: str = 'haversine') -> float:
+        """Return the total length in metres of the geometries."""
+        return fsum(self.lengths(method))
+
+    def locate_points(self, longitudes, latitudes) -> list:
+        """Find the polygons containing each of many positions. Returns a
+        list of (polygon, indices) tuples for the polygons containing at
+        least one position where indices are the positions (in the input)
+        inside the polygon. With NumPy the indices are an array.
+
+        With NumPy the positions are sorted by longitude once, so each
+        polygon only tests the positions within its bounding box. Without
+        NumPy the spatial index finds the candidate polygons of each
+        position."""
+        polygons = [geometry for geometry in self._objects
+                    if isinstance(geometry, Polygon)]
+        results = []
+        if np is not None:
+            longitudes = np.asarray(longitudes, dtype=np.float64)
+            latitudes = np.asarray(latitudes, dtype=np.float64)
+            order = np.argsort(longitudes, kind='stable')
+            sorted_longitudes = longitudes[order]
+            for polygon in polygons:
+                bbox = polygon.bbox()
+                if bbox is None:
+                    continue
+                start = np.searchsorted(sorted_longitudes, bbox[0],
+                                        side='left')
+                end = np.searchsorted(sorted_longitudes, bbox[2],
+                                      side='right')
+                candidates = order[start:end]
+                candidates = candidates[(latitudes[candidates] >= bbox[1]) &
+                                        (latitudes[candidates] <= bbox[3])]
+                inside = _rings_contain_np(polygon._buffers(),
+                                           longitudes[candidates],
+                                           latitudes[candidates])
+                if inside.any():
+                    results.append((polygon, np.sort(candidates[inside])))
+            return results
+
+        index = self._get_index()
+        found = {}
+        rings = {}
+        for i, (x, y) in enumerate(zip(longitudes, latitudes)):
+            for position in index.query((x, y, x, y)):
+                polygon = self._objects[position]
+                if not isinstance(polygon, Polygon):
+                    continue
+                if position not in rings:
+                    rings[position] = [(ring[0::3], ring[1::3])
+                                       for ring in polygon._buffers()]
+                if _rings_contain(rings[position], x, y):
+                    found.setdefault(position, []).append(i)
+        return [(self._objects[position], found[position])
+                for position in sorted(found)]
+
+    def write_wkb(self, wkb_fd):
+        """Write the collection as a WKB GeometryCollection with Z
+        coordinates to a binary file object."""
+        wkb_fd.write(_WKB_HEADER.pack(_WKB_BYTE_ORDER,
+                                      WKB_GEOMETRYCOLLECTION_Z))
+        wkb_fd.write(_WKB_COUNT.pack(len(self._objects)))
+        for geometry in self._objects:
+            geometry.write_wkb(wkb_fd)
+
+    def to_wkb(self) -> bytes:
+        """Return the collection as well-known binary (WKB)."""
+        wkb_fd = BytesIO()
+        self.write_wkb(wkb_fd)
+        return wkb_fd.getvalue()
+
+    def write_geojson(self, geojson_fd):
+        """Write the collection as a GeoJSON FeatureCollection."""
+        write_geojson(geojson_fd, self._objects)
+
+    def simplify(self, tolerance: float,
+                 method: str = 'douglas-peucker') -> 'GeometryCollection':
+        """Return a new collection with the line strings simplified. See
+        LineString.simplify() for the tolerance and methods. Other
+        geometries are included as they are."""
+        return GeometryCollection(
+            geometry.simplify(tolerance, method)
+            if isinstance(geometry, LineString) else geometry
+            for geometry in self._objects)
+
+    def levels_of_detail(self, tolerances: list,
+                         method: str = 'douglas-peucker') -> dict:
+        """Return a dictionary with a simplified collection for each of
+        the tolerances. The vertex weights of each line string are only
+        calculated once and shared by all the levels."""
+        levels = {tolerance: GeometryCollection() for tolerance in tolerances}
+        if len(levels) == 0:
+            return levels
+        for geometry in self._objects:
+            if not isinstance(geometry, LineString):
+                for collection in levels.values():
+                    collection.add(geometry)
+                continue
+            weights = geometry._simplify_weights(
+                method, min(levels), max(levels))
+            for tolerance, collection in levels.items():
+                collection.add(geometry._keep(weights, tolerance))
+        return levels
+
+    def bbox(self) -> (tuple or None):
+        """Return the bounding box of all the geometries as a
+        (min_longitude, min_latitude, max_longitude, max_latitude) tuple
+        or None if there are no coordinates."""
+        return _merge_bboxes(geometry.bbox() for geometry in self._objects)
+
+    def nearest_vertex(self, longitude: float, latitude: float,
+                       method: str = 'haversine') -> (tuple or None):
+        """Return a (geometry, index, distance) tuple for the vertex of
+        any of the geometries that is closest to the given position.
+        The distance is in metres. Returns None if the collection has no
+        coordinates."""
+        buffers = [geometry._vertices() for geometry in self._objects]
+        if np is not None:
+            if sum(len(buffer) for buffer in buffers) == 0:
+                return None
+            offsets = np.cumsum([len(buffer) // 3 for buffer in buffers])
+            packed = np.concatenate([_as_numpy(buffer).ravel()
+                                     for buffer in buffers])
+            index, distance = _nearest_vertex(packed, longitude, latitude,
+                                              method)
+            position = int(np.searchsorted(offsets, index, side='right'))
+            start = int(offsets[position - 1]) if position > 0 else 0
+            return self._objects[position], index - start, distance
+
+        nearest = None
+        for geometry, buffer in zip(self._objects, buffers):
+            candidate = _nearest_vertex(buffer, longitude, latitude, method)
+            if candidate is not None and (nearest is None or
+                                          candidate[1] < nearest[2]):
+                nearest = (geometry, candidate[0], candidate[1])
+        return nearest
 
 
 class Geometry(object):
     _name: (str or None) = None
     _description: (str or None) = None
+    _style_url: (str or None) = None  # The KML styleUrl of the placemark
     _properties: dict = {}  # Arbitrary properties added by the user
     _type: str = None
 
@@ -208,6 +1868,7 @@ class Geometry(object):
         self._type = 'Geometry'
         self._name = None
         self._description = None
+        self._style_url = None
         self._properties = {}
 
     @property
@@ -226,6 +1887,14 @@ class Geometry(object):
     def description(self, description: str):
         self._description = description
 
+    @property
+    def style_url(self):
+        return self._style_url
+
+    @style_url.setter
+    def style_url(self, style_url: str):
+        self._style_url = style_url
+
     @property
     def properties(self):
         return self._properties
@@ -241,19 +1910,236 @@ class Geometry(object):
     def type(self):
         return self._type
 
+    def _vertices(self) -> array:
+        """Return the vertices of the geometry as a packed coordinate
+        buffer. Used by the metrics methods."""
+        return array('d')
+
+    def _buffers(self) -> list:
+        """Return all the packed coordinate buffers of the geometry
+        (several for a polygon with holes). Used for serialization."""
+        return [self._vertices()]
+
+    def write_wkb(self, wkb_fd):
+        """Write the geometry as well-known binary (WKB) with Z
+        coordinates to a binary file object."""
+        raise NotImplementedError(f'WKB is not supported for {self.type}')
+
+    def to_wkb(self) -> bytes:
+        """Return the geometry as well-known binary (WKB) with Z
+        coordinates in the native byte order."""
+        wkb_fd = BytesIO()
+        self.write_wkb(wkb_fd)
+        return wkb_fd.getvalue()
+
+    def bbox(self) -> (tuple or None):
+        """Return the bounding box as a (min_longitude, min_latitude,
+        max_longitude, max_latitude) tuple or None if the geometry has
+        no coordinates."""
+        return _bbox(self._vertices())
+
+    def nearest_vertex(self, longitude: float, latitude: float,
+                       method: str = 'haversine') -> (tuple or None):
+        """Return a (index, distance) tuple for the vertex closest to the
+        given position. The distance is in metres and the method is
+        either haversine or ellipsoidal."""
+        return _nearest_vertex(self._vertices(), longitude, latitude, method)
+
+
+class Coordinate(namedtuple('Coordinate',
+                            ['longitude', 'latitude', 'altitude'],
+                            defaults=[0.0])):
+    """Lightweight, immutable point for bulk use. It has the same
+    longitude, latitude, and altitude accessors as Point and compares
+    equal to a Point at the same position, but it has no name,
+    description, or properties. Coordinates are hashable, so they can be
+    used in sets and as dictionary keys, for example for deduplication.
+    """
+    __slots__ = ()
+
+    def __str__(self):
+        return f'({self.longitude}, {self.latitude}, {self.altitude})'
+
+
+class _CoordinateView(Sequence):
+    """Read-only sequence of the coordinates in a packed coordinate
+    buffer. The Point (or Coordinate) objects are created when they are
+    accessed."""
+    _buffer: array = None
+    _compact: bool = False
+
+    def __init__(self, buffer: array, compact: bool = False):
+        self._buffer = buffer
+        self._compact = compact
+
+    def __len__(self) -> int:
+        return len(self._buffer) // 3
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError('coordinate index out of range')
+        offset = 3 * index
+        if self._compact:
+            return Coordinate._make(self._buffer[offset:offset + 3])
+        return Point(*self._buffer[offset:offset + 3])
+
 
 class LineString(Geometry):
-    _coordinates: list = []
+    _coordinates: array = None  # Packed longitude, latitude, altitude
 
     def __init__(self):
         super().__init__()
         self._type = 'LineString'
-        self._coordinates = []
+        self._coordinates = array('d')
 
     @property
-    def coordinates(self):
+    def coordinates(self) -> Sequence:
+        """Return a read-only sequence of the points. The Point objects
+        are only created when they are accessed."""
+        return _CoordinateView(self._coordinates)
+
+    @property
+    def coordinate_tuples(self) -> Sequence:
+        """Return a read-only sequence of the points as lightweight
+        Coordinate objects, which are only created when they are
+        accessed."""
+        return _CoordinateView(self._coordinates, compact=True)
+
+    @property
+    def packed_coordinates(self) -> array:
+        """Return the coordinates as a flat array of doubles with the
+        longitude, latitude, and altitude of each point. For a line
+        string loaded from a cache, this is a read-only memoryview."""
         return self._coordinates
 
+    def to_numpy(self):
+        """Return the coordinates as an (n, 3) NumPy array sharing the
+        memory of the packed coordinates. No coordinates can be added
+        while the array exists. Requires NumPy."""
+        if np is None:
+            raise ImportError('NumPy is required for to_numpy()')
+        return np.frombuffer(self._coordinates, dtype=np.float64).reshape(
+            -1, 3)
+
+    def _vertices(self) -> array:
+        return self._coordinates
+
+    def length(self, method: str = 'haversine') -> float:
+        """Return the length of the line string in metres. The method is
+        either haversine (spherical Earth) or ellipsoidal (WGS 84)."""
+        distances = _segment_distances(self._coordinates, method)
+        if np is not None:
+            return float(distances.sum())
+        return fsum(distances)
+
+    def cumulative_distance(self, method: str = 'haversine'):
+        """Return the distance in metres from the start of the line
+        string to each vertex. The result is a NumPy array if NumPy is
+        installed, otherwise an array of doubles."""
+        distances = _segment_distances(self._coordinates, method)
+        if np is not None:
+            return np.concatenate(([0.0], np.cumsum(distances)))[
+                :len(self._coordinates) // 3]
+        if len(self._coordinates) == 0:
+            return array('d')
+        return array('d', accumulate(distances, initial=0.0))
+
+    def centroid(self) -> (Coordinate or None):
+        """Return the centroid of the line string weighted by the length
+        of the segments. For a line string without length the mean of the
+        vertices is returned."""
+        if len(self._coordinates) == 0:
+            return None
+        distances = _segment_distances(self._coordinates, 'haversine')
+        if np is not None:
+            xyz = _as_numpy(self._coordinates)
+            total = distances.sum()
+            if total == 0:
+                return Coordinate(*xyz.mean(axis=0).tolist())
+            midpoints = (xyz[:-1] + xyz[1:]) / 2
+            weighted = (midpoints * distances[:, None]).sum(axis=0) / total
+            return Coordinate(*weighted.tolist())
+
+        total = fsum(distances)
+        components = [self._coordinates[i::3] for i in range(3)]
+        if total == 0:
+            return Coordinate(*[fsum(c) / len(c) for c in components])
+        return Coordinate(*[
+            fsum((c[j] + c[j + 1]) / 2 * distances[j]
+                 for j in range(len(distances))) / total
+            for c in components])
+
+    def simplify(self, tolerance: float,
+                 method: str = 'douglas-peucker') -> 'LineString':
+        """Return a simplified copy of the line string. The methods are:
+
+        douglas-peucker: vertices closer than tolerance metres to the
+            simplified line are removed.
+        visvalingam: vertices are removed in order of the area (square
+            metres) of the triangle they form with their neighbours until
+            all areas exceed tolerance.
+
+        The first and last vertex are always kept."""
+        weights = self._simplify_weights(method, tolerance, tolerance)
+        return self._keep(weights, tolerance)
+
+    def _simplify_weights(self, method: str, minimum: float,
+                          maximum: float) -> list:
+        """Return the simplification weights of the vertices that are
+        valid for tolerances between minimum and maximum."""
+        try:
+            function, use_minimum = _SIMPLIFY_METHODS[method]
+        except KeyError:
+            raise ValueError(f'Unknown simplification method "{method}" - ' +
+                             'supported methods: ' +
+                             f'{list(_SIMPLIFY_METHODS)}') from None
+        if len(self._coordinates) < 9:
+            return [inf] * (len(self._coordinates) // 3)
+        xs, ys = _planar(self._coordinates)
+        return function(xs, ys, minimum if use_minimum else maximum)
+
+    def _keep(self, weights: list, tolerance: float) -> 'LineString':
+        """Return a copy of the line string with the vertices with a
+        weight larger than tolerance."""
+        line_string = LineString()
+        line_string.name = self.name
+        line_string.description = self.description
+        line_string.style_url = self.style_url
+        line_string.properties = dict(self.properties)
+        keep = [i for i, weight in enumerate(weights) if weight > tolerance]
+        if np is not None:
+            line_string._coordinates.frombytes(
+                _as_numpy(self._coordinates)[keep].tobytes())
+        else:
+            for i in keep:
+                line_string._coordinates.extend(
+                    self._coordinates[3 * i:3 * i + 3])
+        return line_string
+
+    def write_wkb(self, wkb_fd):
+        """Write the line string as WKB. The coordinates are written
+        directly from the packed buffer without copying them."""
+        wkb_fd.write(_WKB_HEADER.pack(_WKB_BYTE_ORDER, WKB_LINESTRING_Z))
+        wkb_fd.write(_WKB_COUNT.pack(len(self._coordinates) // 3))
+        wkb_fd.write(self._coordinates)
+
+    def _writable(self) -> array:
+        """Return the coordinate buffer after making sure it can be
+        extended. Line strings loaded from a cache use a read-only view
+        of the memory mapped cache file until they are modified."""
+        if not isinstance(self._coordinates, array):
+            self._coordinates = array('d', self._coordinates.tobytes())
+        return self._coordinates
+
+    def add_coordinate(self, longitude: float, latitude: float,
+                       altitude: float = 0.0):
+        """Add a single coordinate to the end of the line string."""
+        self._writable().extend((longitude, latitude, altitude))
+
     def add_coordinates_from_text(self, coordinates: str):
         """Add coordinates from a multiline text document with
         the coordinates split by whitespace. This is for example the
@@ -263,26 +2149,134 @@ class LineString(Geometry):
 
         The third component (altitude) is optional and defaults to 0.
         """
-
-        for coordinate in coordinates.split():
-            self._coordinates.append(Point(*coordinate.split(',')))
+        self._writable().extend(_parse_coordinates(coordinates))
 
     def __repr__(self):
-        points = ', '.join([str(point) for point in self._coordinates])
+        points = ', '.join([str(point) for point in self.coordinate_tuples])
         if self.name is not None:
             return f'<{self.type} \'{self.name}\': {points}>'
         else:
             return f'<{self.type}: {points}>'
 
     def __eq__(self, other) -> bool:
-        if len(self.coordinates) != len(other.coordinates):
+        if isinstance(other, LineString):
+            return self._coordinates == other._coordinates
+        coordinates = self.coordinate_tuples
+        if len(coordinates) != len(other.coordinates):
             return False
-        for i in range(len(self.coordinates)):
-            if self.coordinates[i] != other.coordinates[i]:
+        for i in range(len(coordinates)):
+            if coordinates[i] != other.coordinates[i]:
                 return False
         return True
 
 
+class Polygon(Geometry):
+    """A polygon with an outer boundary and optional inner boundaries
+    (holes). Each boundary is a closed ring stored as a packed
+    coordinate buffer like the coordinates of a LineString."""
+    _outer: array = None
+    _inner: list = []
+
+    def __init__(self):
+        super().__init__()
+        self._type = 'Polygon'
+        self._outer = array('d')
+        self._inner = []
+
+    @property
+    def outer_boundary(self) -> Sequence:
+        """Return the coordinates of the outer boundary."""
+        return _CoordinateView(self._outer)
+
+    @property
+    def inner_boundaries(self) -> list:
+        """Return a list with the coordinates of each inner boundary."""
+        return [_CoordinateView(ring) for ring in self._inner]
+
+    @property
+    def outer_boundary_tuples(self) -> Sequence:
+        """Return the coordinates of the outer boundary as Coordinate
+        objects."""
+        return _CoordinateView(self._outer, compact=True)
+
+    @property
+    def inner_boundary_tuples(self) -> list:
+        """Return a list with the coordinates of each inner boundary as
+        Coordinate objects."""
+        return [_CoordinateView(ring, compact=True) for ring in self._inner]
+
+    def set_outer_boundary_from_text(self, coordinates: str):
+        """Set the outer boundary from the KML coordinates format."""
+        self._outer = _parse_coordinates(coordinates)
+
+    def add_inner_boundary_from_text(self, coordinates: str):
+        """Add an inner boundary from the KML coordinates format."""
+        self._inner.append(_parse_coordinates(coordinates))
+
+    def _vertices(self) -> array:
+        return self._outer
+
+    def _buffers(self) -> list:
+        return [self._outer] + self._inner
+
+    def write_wkb(self, wkb_fd):
+        wkb_fd.write(_WKB_HEADER.pack(_WKB_BYTE_ORDER, WKB_POLYGON_Z))
+        wkb_fd.write(_WKB_COUNT.pack(1 + len(self._inner)))
+        for ring in self._buffers():
+            wkb_fd.write(_WKB_COUNT.pack(len(ring) // 3))
+            wkb_fd.write(ring)
+
+    def contains(self, longitude: float, latitude: float) -> bool:
+        """Return whether a position is inside the polygon (and not in
+        one of its holes)."""
+        return bool(self.contains_points([longitude], [latitude])[0])
+
+    def contains_points(self, longitudes, latitudes):
+        """Return for each of the positions whether it is inside the
+        polygon. The positions are given as two sequences (or NumPy
+        arrays) and the result is a NumPy boolean array when NumPy is
+        installed, otherwise a list of booleans. The calculation is
+        planar in longitude and latitude using the even-odd rule, so
+        holes are excluded. Only the positions inside the bounding box
+        are tested against the boundaries."""
+        bbox = _bbox(self._outer)
+        if np is not None:
+            longitudes = np.asarray(longitudes, dtype=np.float64)
+            latitudes = np.asarray(latitudes, dtype=np.float64)
+            inside = np.zeros(len(longitudes), dtype=bool)
+            if bbox is None:
+                return inside
+            candidates = np.flatnonzero(
+                (longitudes >= bbox[0]) & (longitudes <= bbox[2]) &
+                (latitudes >= bbox[1]) & (latitudes <= bbox[3]))
+            inside[candidates] = _rings_contain_np(
+                self._buffers(), longitudes[candidates],
+                latitudes[candidates])
+            return inside
+
+        inside = [False] * len(longitudes)
+        if bbox is None:
+            return inside
+        rings = [(ring[0::3], ring[1::3]) for ring in self._buffers()]
+        for i, (x, y) in enumerate(zip(longitudes, latitudes)):
+            if bbox[0] <= x <= bbox[2] and bbox[1] <= y <= bbox[3]:
+                inside[i] = _rings_contain(rings, x, y)
+        return inside
+
+    def __repr__(self):
+        points = ', '.join([str(point)
+                            for point in self.outer_boundary_tuples])
+        if self.name is not None:
+            return f'<{self.type} \'{self.name}\': {points}>'
+        else:
+            return f'<{self.type}: {points}>'
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, Polygon):
+            return False
+        return self._buffers() == other._buffers()
+
+
 class Point(Geometry):
     _longitude: float = 0.0
     _latitude: float = 0.0
@@ -306,6 +2300,18 @@ class Point(Geometry):
         if altitude is not None:
             self._altitude = altitude
 
+    @property
+    def coordinate(self) -> Coordinate:
+        """Return the position of the point as a Coordinate."""
+        return Coordinate(self._longitude, self._latitude, self._altitude)
+
+    def _vertices(self) -> array:
+        return array('d', (self._longitude, self._latitude, self._altitude))
+
+    def write_wkb(self, wkb_fd):
+        wkb_fd.write(_WKB_HEADER.pack(_WKB_BYTE_ORDER, WKB_POINT_Z))
+        wkb_fd.write(self._vertices())
+
     @property
     def longitude(self):
         return self._longitude
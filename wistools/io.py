@@ -2,6 +2,7 @@ from bz2 import BZ2File
 from contextlib import contextmanager
 from gzip import GzipFile
 from mimetypes import guess_type
+from os import getpid, replace
 from pathlib import Path
 import re
 from zipfile import ZipFile
@@ -42,6 +43,28 @@ def opened_w_error(filename, mode='r'):
             f.close()
 
 
+@contextmanager
+def atomic_write(filepath: (str or Path)):
+    """Open a temporary file next to filepath for writing in binary mode
+    and replace filepath with it when the "with" block completes, so
+    readers never see a partially written file. If the block raises an
+    exception, the temporary file is removed and filepath is left
+    unchanged. Example usage:
+
+    with atomic_write('/tmp/data.bin') as f:
+        f.write(data)
+    """
+    file = Path(filepath)
+    temp_file = file.with_name(f'{file.name}.{getpid()}.tmp')
+    try:
+        with temp_file.open(mode='wb') as f:
+            yield f
+        replace(temp_file, file)
+    except BaseException:
+        temp_file.unlink(missing_ok=True)
+        raise
+
+
 def open_file(filepath: (str or Path), mode: str = 'rb',
               encoding: (str or None) = None, compresslevel: int = 9):
     """Open a file with optionally transparent compression.
@@ -75,7 +98,9 @@ def open_file(filepath: (str or Path), mode: str = 'rb',
     elif encoding == 'bzip2':
         fs = BZ2File(file, mode=mode, compresslevel=compresslevel)
     elif encoding == 'zip':
-        fs = ZipFile(file, mode=mode, compresslevel=compresslevel)
+        # ZipFile does not take the binary/text part of the mode
+        fs = ZipFile(file, mode=mode.replace('b', '').replace('t', ''),
+                     compresslevel=compresslevel)
     else:
         fs = file.open(mode=mode, encoding=encoding)
 
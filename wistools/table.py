@@ -156,9 +156,9 @@ class Table(object):
                                multiline=multiline)
         return formats.bar.rstrip('\n')
 
-    def _ml_row(self, row: list, frame: bool, spacing: int):
+    def _ml_lines(self, row: list, frame: bool, spacing: int):
+        """Yield the lines of a row with multiline values."""
         # Split the column values by newline (for strings)
-        output = ''
         columns = []
         max_lines = 0
         i = 0
@@ -196,9 +196,7 @@ class Table(object):
             if frame:
                 str_row += '|'
 
-            output += str_row.rstrip() + '\n'
-
-        return output
+            yield str_row.rstrip()
 
     def generate(self, frame: bool = False, spacing: int = 3,
                  multiline: bool = False) -> str:
@@ -211,32 +209,66 @@ class Table(object):
         specially.
         """
 
-        if len(self._rows) == 0:
-            # No rows, so nothing to generate an output from.
-            # Just return an empty string
-            return ''
+        return '\n'.join(self.iter_lines(frame=frame, spacing=spacing,
+                                         multiline=multiline))
 
+    def iter_lines(self, frame: bool = False, spacing: int = 3,
+                   multiline: bool = False):
+        """Generate the table one line at a time (without the newline).
+        The arguments are the same as for generate(), and joining the
+        lines with newlines gives the same output as generate(). Only
+        the current line is kept in memory, so this can be used for
+        tables with very many rows."""
+        if len(self._rows) == 0:
+            return
+
+        # generate() has always stripped the trailing newlines, so empty
+        # lines are only output once they are followed by another line.
+        empty_lines = 0
+        for line in self._iter_lines(frame, spacing, multiline):
+            if line == '':
+                empty_lines += 1
+                continue
+            while empty_lines > 0:
+                yield ''
+                empty_lines -= 1
+            yield line
+
+    def _iter_lines(self, frame: bool, spacing: int, multiline: bool):
+        """Yield all the lines of the table including trailing empty
+        lines."""
         formats = self.formats(frame=frame, spacing=spacing,
                                multiline=multiline)
-        output = self.generate_header(frame=frame, spacing=spacing,
-                                      multiline=multiline)
-        output += '\n'
+        bar = formats.bar.rstrip('\n')
+        format_row = formats.row[:-1].format
+        separators = set(self._separators)
+        if frame:
+            yield bar
+        yield formats.header[:-1].format(*self._headers)
+        yield bar
         i = 0
         for row in self._rows:
             i += 1
             if multiline:
-                output += self._ml_row(row, frame, spacing)
+                yield from self._ml_lines(row, frame, spacing)
             else:
-                output += formats.row.format(*row).rstrip() + '\n'
+                yield format_row(*row).rstrip()
 
-            if i in self._separators:
-                output += self.generate_separator(frame=frame, spacing=spacing,
-                                                  multiline=multiline) + '\n'
+            if i in separators:
+                yield bar
 
         if frame:
-            output += formats.bar
-
-        return output.rstrip('\n')
+            yield bar
+
+    def write(self, fp, frame: bool = False, spacing: int = 3,
+              multiline: bool = False):
+        """Write the table to a file-like object in text mode one line at
+        a time. The output is the same as for
+        print(table.generate(), file=fp), except nothing is written for
+        a table without rows."""
+        fp.writelines(f'{line}\n' for line in
+                      self.iter_lines(frame=frame, spacing=spacing,
+                                      multiline=multiline))
 
     def _update_column_widths(self, row: list):
         """Update the column widths by setting it to the maximum of the